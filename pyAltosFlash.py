@@ -23,14 +23,30 @@
 # serial loader.
 #
 
-import os
 import platform
+import re
 import sys
 import traceback
 import serial
-import serial.tools.list_ports
-import time
+import pyPortScan
 
+LOADER_TYPE='altos'
+
+
+def CandidatePorts():
+    "List the serial ports that an Altos loader might be on"
+    if platform.system() == 'Windows':
+        baseDevice='COM'
+    else:
+        baseDevice='/dev/ttyACM'
+    return pyPortScan.GrepPorts(baseDevice)
+
+def FindLoaders(debug=False,deadline=10.0,findAll=False):
+    "Probe all the candidate ports at once; return the first (or all) loaders"
+    return pyPortScan.CachedScan(LOADER_TYPE,CandidatePorts(),
+                                 lambda port: FlashLdr(device=port,debug=debug),
+                                 lambda port: FlashLdr(device=port,debug=debug,timeout=0.3),
+                                 deadline,findAll)
 
 class FlashLdr:
     "A representation of the Altos Flash Loader"
@@ -38,18 +54,24 @@ class FlashLdr:
     # Note:  You should be able to make different classes to represent different
     # loaders with the same methods, and get this whole thing to work
     #
-    def __init__(self,device=None,debug=False):
+    def __init__(self,device=None,debug=False,timeout=1):
         #First, for the Altos device on Linux, it will be one of these
         self.IsAltosFlash=False
         output = bytearray([118]) # This is a bytearray of 1 with the letter 'v'
         self.gotDevice=False
         if(device==None):
-            if platform.system() == 'Windows':
-                baseDevice='COM'
-            else:
-                baseDevice='/dev/ttyACM'
+            # Try all the possible ports at the same time; each one that
+            # is not a loader costs us a readline timeout.
+            found = FindLoaders(debug)
+            if(not found):
+                raise ValueError('No loader responding in '+
+                                 ' '.join(CandidatePorts())+' ports')
+            self.__dict__.update(found[0].__dict__)
+            return
         else:
-            baseDevice=device
+            # Match only this port (so ttyACM1 does not also find ttyACM10).
+            # If it is not listed (a pty, for example) just try to open it.
+            portNames=pyPortScan.GrepPorts(re.escape(device)+'$') or [device]
             possibleUnits=['']
 
 
@@ -58,8 +80,7 @@ class FlashLdr:
         # it should.  We might use the non-Grep version but in Linux
         # we might have a zillion devices to iterate through.
 
-        portInfos = serial.tools.list_ports.grep(baseDevice)
-        for pi in portInfos:
+        for devName in portNames:
             # This for is interating through the available serial devices
             try:
                 # Ok, we'll try to open the device names that we found
@@ -68,9 +89,8 @@ class FlashLdr:
                 # look like an Altos loader, SerialException is raised
                 # and we try again
 
-                devName = pi[0]
                 print(devName)
-                self.port=serial.Serial(devName,timeout=1)
+                self.port=serial.Serial(devName,timeout=timeout)
                 self.gotDevice=True
                 if(debug):
                     print("Checking device "+devName)
@@ -104,17 +124,25 @@ class FlashLdr:
                         self.IsAltosFlash=True
                     if(debug):
                         sys.stdout.write(string)
+                self.dev = devName
             except serial.SerialException:
                 pass
             except:
                 traceback.print_exc()
             if(self.IsAltosFlash):
+                self.port.timeout=1
                 break;
+            if(hasattr(self,'port')):
+                self.port.close() # Not a loader; leave it for someone else
         if(not self.gotDevice):
-            raise ValueError('No loader responding in '+baseDevice+' ports')
+            raise ValueError('No loader responding in '+device+' ports')
     def GetDevice(self):
         "Get the OS name of the device that communicates with the loader"
         return self.dev
+
+    def Close(self):
+        "Let go of the serial port"
+        self.port.close()
     
     def GetLowAddr(self):
         "Get the low address that the loader has told us its embedded device has"
@@ -128,9 +156,19 @@ class FlashLdr:
         "Get the page size of this device"
         return 0x100 # If we could get it from the loader, we should
     
+    def SupportsCRC(self):
+        "True if the loader can return a CRC of a range of flash"
+        return False
+
+    def NegotiateBaud(self,baud=None):
+        "The Altos loader is on USB, so there is no baud rate to change"
+        return None
+
     def ReadPage(self,address,size):
+        # No flushOutput here or in WritePage: the loader does not answer a
+        # write, so the end of the previous page may not have gone out yet
+        # and flushOutput would throw it away.
         self.port.flushInput()
-        self.port.flushOutput()
         command = 'R '+ hex(address)[2:]+'\n' #Don't want the 0x in front
         self.port.write(command.encode())
         contents = bytearray(size)   
@@ -141,7 +179,6 @@ class FlashLdr:
         sys.stdout.write('.')
         sys.stdout.flush()
         self.port.flushInput()
-        self.port.flushOutput()
         command = 'W '+ hex(address)[2:]+'\n' #Don't want the 0x in front
         self.port.write(command.encode())
         self.port.write(outBuf)
@@ -0,0 +1,408 @@
+# /* Copyright (C) 2026 Burns Fisher
+#  *
+#  * This program is free software; you can redistribute it and/or modify
+#  * it under the terms of the GNU General Public License as published by
+#  * the Free Software Foundation; either version 2 of the License, or
+#  * (at your option) any later version.
+#  *
+#  * This program is distributed in the hope that it will be useful,
+#  * but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  * GNU General Public License for more details.
+#  *
+#  * You should have received a copy of the GNU General Public License along
+#  * with this program; if not, write to the Free Software Foundation, Inc.,
+#  * 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#  *
+#  */
+
+#
+# Throughput benchmarks for the flashing pipeline.  There are two kinds:
+#
+#  - End to end: read an ELF file into a FirmwareImage, load it into
+#    pyMicromem, write it with the real FlashLdr class to a simulated loader
+#    from pySimLoader and verify it, timing each phase.  This is done for
+#    each protocol at each of the baud rates and latencies asked for.
+#  - Micro benchmarks of the pieces that are pure Python: SimpleElf.GetCode,
+#    IterCode and GetSymbols, building a FirmwareImage, Device.PutByte,
+#    PutBlock, LoadImage and MemoryCompare and the serial loader checksum,
+#    plus the time to import what pyMicroloader needs for
+#    each loader (from python -X importtime).
+#
+# Results are printed and can be saved as JSON.  Give an earlier JSON file
+# with --compare to see what got slower.
+#
+#   python pyBenchmark.py [--elf file] [--size n] [--baud 57600,115200]
+#       [--latency 0,0.002] [--protocols altos,amsat,amsat-old,ti,ti-g]
+#       [--micro-only] [--e2e-only] [--negotiate] [--output results.json]
+#       [--compare old.json]
+#
+
+import getopt
+import json
+import os
+import platform
+import random
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+PROTOCOLS = ['altos','amsat-old','amsat','ti','ti-g']
+SYMBOLS = ['ao_serial_number','ao_romconfig_version','ao_romconfig_check']
+# What pyMicroloader imports for each loader
+STARTUP_MODULES = {'altos':['pyPortScan','pyAltosFlash','pySimpleElf','pyMicromem'],
+                   'amsat':['pyPortScan','pySerialFlash','pySimpleElf','pyMicromem'],
+                   'ti':['pyPortScan','pyTISerialFlash']}
+
+def MakeElf(path,size=0x8000,base=0x8000000,seed=1):
+    # Write a small 32-bit ARM ELF file with one loadable segment of size
+    # bytes at base, and the three symbols pyMicroloader looks for.  There
+    # is a run of 0xFF in the middle the way a padded image would have.
+    rng = random.Random(seed)
+    text = bytearray(rng.getrandbits(8) for i in range(0,size))
+    text[size//2:size//2+size//8] = b'\xff'*(size//8)
+    # ao_serial_number, ao_romconfig_version and ao_romconfig_check
+    text[0x100:0x108] = struct.pack('<IHH',0,1,0xfffe)
+    strtab = b'\x00ao_serial_number\x00ao_romconfig_version\x00ao_romconfig_check\x00'
+    names = [1,strtab.index(b'ao_romconfig_version'),strtab.index(b'ao_romconfig_check')]
+    symtab = bytes(16)+b''.join(struct.pack('<IIIBBH',name,base+0x100+offset,length,0x11,0,1)
+                                for name,offset,length in zip(names,[0,4,6],[4,2,2]))
+    shstrtab = b'\x00.text\x00.symtab\x00.strtab\x00.shstrtab\x00'
+
+    textOffset = 0x100
+    symOffset = textOffset+size
+    strOffset = symOffset+len(symtab)
+    shstrOffset = strOffset+len(strtab)
+    shOffset = (shstrOffset+len(shstrtab)+3) & ~3
+    header = b'\x7fELF\x01\x01\x01'+bytes(9)+struct.pack(
+        '<HHIIIIIHHHHHH',2,40,1,base,52,shOffset,0x5000000,52,32,1,40,5,4)
+    program = struct.pack('<IIIIIIII',1,textOffset,base,base,size,size,5,4)
+    sections = [bytes(40),
+                struct.pack('<IIIIIIIIII',1,1,6,base,textOffset,size,0,0,4,0),
+                struct.pack('<IIIIIIIIII',7,2,0,0,symOffset,len(symtab),3,1,4,16),
+                struct.pack('<IIIIIIIIII',15,3,0,0,strOffset,len(strtab),0,0,1,0),
+                struct.pack('<IIIIIIIIII',23,3,0,0,shstrOffset,len(shstrtab),0,0,1,0)]
+    with open(path,'wb') as file:
+        file.write(header+program)
+        file.write(bytes(textOffset-file.tell()))
+        file.write(text+symtab+strtab+shstrtab)
+        file.write(bytes(shOffset-file.tell()))
+        file.write(b''.join(sections))
+
+class MemoryLoader(object):
+    'A loader with no wire at all, for timing the host side by itself'
+
+    def __init__(self,low=0x8000000,high=0x8100000-1):
+        self.low = low
+        self.high = high
+        self.flash = bytearray(b'\xff'*(high-low+1))
+
+    def GetLowAddr(self):
+        return self.low
+
+    def GetHighAddr(self):
+        return self.high
+
+    def GetPageSize(self):
+        return 0x100
+
+    def SupportsCRC(self):
+        return False
+
+    def ReadPage(self,address,size):
+        offset = address-self.low
+        return bytearray(self.flash[offset:offset+size])
+
+    def WritePage(self,outBuf,address):
+        offset = address-self.low
+        self.flash[offset:offset+len(outBuf)] = outBuf
+
+def _Best(function,repeat=5):
+    # Best of several runs, in seconds
+    best = None
+    for i in range(0,repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter()-start
+        best = elapsed if best is None else min(best,elapsed)
+    return best
+
+def StartupTimes(repeat=3):
+    # Import what pyMicroloader needs for each loader in a new Python
+    # with -X importtime, and add up the time of the top level imports
+    # (nested ones are indented further).  Returns the best total, in
+    # seconds, for each loader.
+    here = os.path.dirname(os.path.abspath(__file__))
+    results = {}
+    for loader,modules in STARTUP_MODULES.items():
+        best = None
+        for i in range(0,repeat):
+            output = subprocess.run([sys.executable,'-X','importtime','-c',
+                                     'import '+','.join(modules)],
+                                    cwd=here,capture_output=True,text=True).stderr
+            total = 0
+            for line in output.splitlines():
+                fields = line.split('|')
+                if len(fields) == 3 and fields[1].strip().isdigit() and \
+                   not fields[2].startswith('  '):
+                    total += int(fields[1])
+            best = total if best is None else min(best,total)
+        results['startup '+loader] = {'seconds':best/1e6}
+    return results
+
+def _ReadElf(elfName):
+    import pySimpleElf
+    with pySimpleElf.SimpleElf(elfName) as elf:
+        symbols = elf.GetSymbols(SYMBOLS)
+        sections = [[data,address] for address,data in elf.IterCode()]
+    return sections,symbols
+
+def MicroBenchmarks(elfName):
+    import pyFirmwareImage
+    import pyMicromem
+    import pySerialFlash
+    import pySimpleElf
+    results = {}
+    sections,symbols = _ReadElf(elfName)
+    imageBytes = sum(len(data) for data,address in sections)
+
+    def GetCode():
+        with pySimpleElf.SimpleElf(elfName) as elf:
+            while elf.GetCode() != None:
+                pass
+    seconds = _Best(GetCode)
+    results['SimpleElf.GetCode'] = {'seconds':seconds,'bytesPerSec':imageBytes/seconds}
+
+    def IterCode():
+        with pySimpleElf.SimpleElf(elfName) as elf:
+            for address,data in elf.IterCode():
+                pass
+    seconds = _Best(IterCode)
+    results['SimpleElf.IterCode'] = {'seconds':seconds,'bytesPerSec':imageBytes/seconds}
+
+    def GetSymbols():
+        # A new SimpleElf every time, so that building the index is counted
+        with pySimpleElf.SimpleElf(elfName) as elf:
+            elf.GetSymbols(SYMBOLS)
+    seconds = _Best(GetSymbols)
+    results['SimpleElf.GetSymbols x3'] = {'seconds':seconds}
+    results.update(StartupTimes())
+
+    def PutByte():
+        device = pyMicromem.Device(0x8000000,0x80fffff,MemoryLoader())
+        for data,address in sections:
+            for i in range(0,len(data)):
+                device.PutByte(data[i],address+i)
+    seconds = _Best(PutByte,repeat=3)
+    results['Device.PutByte'] = {'seconds':seconds,'bytesPerSec':imageBytes/seconds}
+
+    def PutBlock():
+        device = pyMicromem.Device(0x8000000,0x80fffff,MemoryLoader())
+        for data,address in sections:
+            device.PutBlock(data,address)
+    seconds = _Best(PutBlock)
+    results['Device.PutBlock'] = {'seconds':seconds,'bytesPerSec':imageBytes/seconds}
+
+    seconds = _Best(lambda: pyFirmwareImage.FromFile(elfName,symbolNames=SYMBOLS))
+    results['FirmwareImage.FromFile'] = {'seconds':seconds,'bytesPerSec':imageBytes/seconds}
+
+    image = pyFirmwareImage.FromFile(elfName)
+    def LoadImage():
+        device = pyMicromem.Device(0x8000000,0x80fffff,MemoryLoader())
+        device.LoadImage(image)
+    seconds = _Best(LoadImage)
+    results['Device.LoadImage'] = {'seconds':seconds,'bytesPerSec':imageBytes/seconds}
+
+    loader = MemoryLoader()
+    device = pyMicromem.Device(0x8000000,0x80fffff,loader)
+    for data,address in sections:
+        device.PutBlock(data,address)
+    device.MemoryFlush()
+    seconds = _Best(device.MemoryCompare)
+    results['Device.MemoryCompare'] = {'seconds':seconds,'bytesPerSec':imageBytes/seconds}
+
+    page = bytes(random.Random(2).getrandbits(8) for i in range(0,0x100))
+    count = 1000
+    seconds = _Best(lambda: [pySerialFlash.FlashLdr._Checksum(page) for i in range(0,count)])
+    results['pySerialFlash checksum'] = {'seconds':seconds/count,
+                                         'bytesPerSec':count*len(page)/seconds}
+    return results
+
+def _Phase(phases,name,sim,function):
+    sim.ResetCounters()
+    start = time.perf_counter()
+    value = function()
+    phases[name] = {'seconds':time.perf_counter()-start,'roundTrips':sim.roundTrips,
+                    'bytesIn':sim.bytesIn,'bytesOut':sim.bytesOut}
+    return value
+
+def EndToEnd(protocol,elfName,baud,latency,negotiate=False):
+    # One full flash of the image to a simulated loader.  Returns the
+    # per-phase times and round trips.  With negotiate the loader is asked
+    # to move to a faster baud rate as part of connecting.
+    import pyFirmwareImage
+    import pyMicromem
+    import pySimLoader
+    if protocol == 'altos':
+        import pyAltosFlash as ldr
+        sim = pySimLoader.AltosSim(baud=baud,latency=latency)
+    elif protocol in ('ti','ti-g'):
+        import pyTISerialFlash as ldr
+        # The TI loader's flash has to start where the image does.  ti-g
+        # is a loader that can take the image streamed (YMODEM-G).
+        base = pyFirmwareImage.FromFile(elfName).ToBinary()[0]
+        features = ('baud','ymodem-g') if protocol == 'ti-g' else ('baud',)
+        sim = pySimLoader.TISim(low=base,high=base+0x400000,features=features,
+                                baud=baud,latency=latency)
+    else:
+        import pySerialFlash as ldr
+        features = () if protocol == 'amsat-old' else ('stream','crc','baud')
+        sim = pySimLoader.AmsatSim(features=features,baud=baud,latency=latency)
+    device = sim.Start()
+    phases = {}
+    try:
+        def Connect():
+            loader = ldr.FlashLdr(device=device)
+            if negotiate:
+                loader.NegotiateBaud()
+            return loader
+        loader = _Phase(phases,'connect',sim,Connect)
+        linkBaud = sim.baud
+        if protocol in ('ti','ti-g'):
+            # Flattened in memory, as pyMicroloader does it
+            base,binary = _Phase(phases,'parse',sim,
+                                 lambda: pyFirmwareImage.FromFile(elfName).ToBinary())
+            imageBytes = len(binary)
+            pagesElided = 0
+            if not _Phase(phases,'download',sim,
+                          lambda: loader.download_image('bench.bin',binary)):
+                raise ValueError(protocol+' download failed')
+            if sim.received[1] != binary:
+                raise ValueError(protocol+' download did not match')
+            transport = loader.transfer_counters
+        else:
+            transport = None
+            image = _Phase(phases,'parse',sim,
+                           lambda: pyFirmwareImage.FromFile(elfName,symbolNames=SYMBOLS))
+            imageBytes = image.Stats()['bytes']
+            ihu = pyMicromem.Device(loader.GetLowAddr(),loader.GetHighAddr(),loader)
+            _Phase(phases,'page',sim,lambda: ihu.LoadImage(image))
+            _Phase(phases,'flush',sim,ihu.MemoryFlush)
+            pagesElided = ihu.pagesElided
+            failures = _Phase(phases,'verify',sim,ihu.MemoryCompare)
+            if failures:
+                raise ValueError(protocol+' verify failed')
+        loader.Close()
+    finally:
+        sim.Stop()
+    total = sum(phase['seconds'] for name,phase in phases.items() if name != 'connect')
+    return {'protocol':protocol,'baud':baud,'linkBaud':linkBaud,'latency':latency,
+            'imageBytes':imageBytes,'pagesElided':pagesElided,
+            'seconds':total,'bytesPerSec':imageBytes/total,
+            'roundTrips':sum(phase['roundTrips'] for phase in phases.values()),
+            'phases':phases,'transport':transport}
+
+def Compare(old,new,threshold=1.1):
+    # Print anything that is more than threshold times slower than before
+    print("\nCompared with earlier results:")
+    oldMicro = old.get('micro',{})
+    for name,result in new.get('micro',{}).items():
+        if name in oldMicro:
+            ratio = result['seconds']/oldMicro[name]['seconds']
+            print("  %-28s %6.2fx%s" % (name,ratio,'  SLOWER' if ratio > threshold else ''))
+    oldRuns = {(run['protocol'],run['baud'],run['latency']):run for run in old.get('endToEnd',[])}
+    for run in new.get('endToEnd',[]):
+        key = (run['protocol'],run['baud'],run['latency'])
+        if key in oldRuns:
+            ratio = run['seconds']/oldRuns[key]['seconds']
+            print("  %-28s %6.2fx%s" % ('%s %d baud %gs' % key,ratio,
+                                        '  SLOWER' if ratio > threshold else ''))
+
+def main():
+    try:
+        opts,args = getopt.getopt(sys.argv[1:],"",
+                                  ["elf=","size=","baud=","latency=","protocols=",
+                                   "micro-only","e2e-only","negotiate","output=","compare="])
+    except getopt.GetoptError as err:
+        print(err)
+        sys.exit(1)
+    elfName = None
+    size = 0x8000
+    bauds = [115200]
+    latencies = [0.001]
+    protocols = PROTOCOLS
+    micro = True
+    endToEnd = True
+    negotiate = False
+    outputName = None
+    compareName = None
+    for o,a in opts:
+        if o == "--elf":
+            elfName = a
+        elif o == "--size":
+            size = int(a,0)
+        elif o == "--baud":
+            bauds = [int(b) for b in a.split(',')]
+        elif o == "--latency":
+            latencies = [float(l) for l in a.split(',')]
+        elif o == "--protocols":
+            protocols = a.split(',')
+        elif o == "--micro-only":
+            endToEnd = False
+        elif o == "--e2e-only":
+            micro = False
+        elif o == "--negotiate":
+            negotiate = True
+        elif o == "--output":
+            outputName = a
+        elif o == "--compare":
+            compareName = a
+
+    tempDir = tempfile.TemporaryDirectory()
+    if elfName is None:
+        elfName = os.path.join(tempDir.name,'bench.elf')
+        MakeElf(elfName,size)
+
+    results = {'python':platform.python_version(),'platform':platform.platform(),
+               'time':time.strftime('%Y-%m-%dT%H:%M:%S'),'elf':os.path.basename(elfName)}
+    if micro:
+        results['micro'] = MicroBenchmarks(elfName)
+        print("\n%-28s %12s %14s" % ('Micro benchmark','seconds','bytes/sec'))
+        for name,result in results['micro'].items():
+            print("%-28s %12.6f %14s" % (name,result['seconds'],
+                                         '%.0f' % result['bytesPerSec'] if 'bytesPerSec' in result else ''))
+    if endToEnd:
+        runs = []
+        for protocol in protocols:
+            for baud in bauds:
+                for latency in latencies:
+                    runs.append(EndToEnd(protocol,elfName,baud,latency,negotiate))
+        results['endToEnd'] = runs
+        print("\n%-10s %8s %8s %8s %9s %10s %11s  %s" % ('Protocol','Baud','Link','Latency',
+                                                       'Seconds','Bytes/sec','Round trips',
+                                                       'Phases'))
+        for run in runs:
+            print("%-10s %8d %8d %8g %9.2f %10.0f %11d  %s" % (
+                run['protocol'],run['baud'],run['linkBaud'],run['latency'],run['seconds'],
+                run['bytesPerSec'],
+                run['roundTrips'],' '.join('%s=%.2f' % (name,phase['seconds'])
+                                           for name,phase in run['phases'].items())))
+        for run in runs:
+            counters = run['transport']
+            if counters:
+                print("%-10s %8d %8g  ymodem writes=%d reads=%d stalls=%d (%.2f s)" % (
+                    run['protocol'],run['baud'],run['latency'],counters['writes'],
+                    counters['reads'],counters['stalls'],counters['stall_seconds']))
+    tempDir.cleanup()
+
+    if outputName is not None:
+        with open(outputName,'w') as file:
+            json.dump(results,file,indent=2)
+    if compareName is not None:
+        with open(compareName,'r') as file:
+            Compare(json.load(file),results)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+# /* Copyright (C) 2026 Burns Fisher
+#  * 
+#  * This program is free software; you can redistribute it and/or modify
+#  * it under the terms of the GNU General Public License as published by
+#  * the Free Software Foundation; either version 2 of the License, or
+#  * (at your option) any later version.
+#  *
+#  * This program is distributed in the hope that it will be useful,
+#  * but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  * GNU General Public License for more details.
+#  *
+#  * You should have received a copy of the GNU General Public License along
+#  * with this program; if not, write to the Free Software Foundation, Inc.,
+#  * 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#  * 
+#  */
+
+#
+# This module remembers, on the host, a hash of every page that was last
+# written to a device with a given serial number.  pyMicromem uses it for
+# "delta" flashing: pages whose new contents hash the same as what we last
+# wrote to that board are not sent again.
+#
+
+import hashlib
+import os
+import pyHostCache
+
+class DeltaCache(object):
+    'Per-board record of the page hashes last written to flash'
+
+    def __init__(self,serial,pageSize):
+        self.serial = serial
+        self.pageSize = pageSize
+        self.path = os.path.join(pyHostCache.CacheDir('delta'),str(serial)+'.json')
+        saved = pyHostCache.LoadJson(self.path,{})
+        if(saved.get('pageSize') == pageSize):
+            self.pages = {int(addr,16):digest for addr,digest in
+                          saved.get('pages',{}).items()}
+        else:
+            self.pages = {}
+
+    @staticmethod
+    def PageHash(contents):
+        return hashlib.sha1(contents).hexdigest()
+
+    def Confirm(self,loader,count=3):
+        # Before trusting the cache, make sure the device still holds what
+        # we think it does.  If not, forget everything so that the whole
+        # image is written.
+        if(len(self.pages) == 0):
+            return False
+        addr = pyHostCache.FirstMismatch(loader,self.pages,self.pageSize,
+                                         self.PageHash,count)
+        if(addr is not None):
+            print("\nDelta cache for serial "+str(self.serial)+
+                  " does not match device at "+hex(addr)+"; writing all pages")
+            self.pages = {}
+            return False
+        return True
+
+    def Matches(self,address,contents):
+        return self.pages.get(address) == self.PageHash(contents)
+
+    def Update(self,address,contents):
+        self.pages[address] = self.PageHash(contents)
+
+    def Forget(self,first,last):
+        # The device does not hold what we think between first and last,
+        # so those pages have to be written next time
+        for addr in list(self.pages):
+            if(addr <= last and addr+self.pageSize > first):
+                del self.pages[addr]
+
+    def Save(self):
+        pyHostCache.SaveJson(self.path,{'serial':self.serial,
+                                        'pageSize':self.pageSize,
+                                        'pages':{hex(addr):digest for addr,digest in
+                                                 self.pages.items()}})
@@ -0,0 +1,282 @@
+# /* Copyright (C) 2026 Burns Fisher
+#  *
+#  * This program is free software; you can redistribute it and/or modify
+#  * it under the terms of the GNU General Public License as published by
+#  * the Free Software Foundation; either version 2 of the License, or
+#  * (at your option) any later version.
+#  *
+#  * This program is distributed in the hope that it will be useful,
+#  * but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  * GNU General Public License for more details.
+#  *
+#  * You should have received a copy of the GNU General Public License along
+#  * with this program; if not, write to the Free Software Foundation, Inc.,
+#  * 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#  *
+#  */
+
+#
+# A firmware image laid out the way it will be written: in flash pages.
+# It is built once from any image file (see pyImageFile) before we talk to
+# the loader, so we know which pages will be written, which are only partly
+# covered by the image, which are all erased bytes, and the CRC of each,
+# without any I/O.  pyMicromem.Device.LoadImage takes it a page at a time.
+#
+# Only the pages the image touches are kept.  Each one gets a page-sized
+# slot in one bytearray (padded with erased bytes), and a coverage mask
+# with a 1 for each byte that the image actually has.
+#
+# A FirmwareImage can be saved as a "flash plan" and read back much faster
+# than the image file can be parsed.  CachedFromFile keeps plans in the
+# host cache, keyed by a hash of the image file, so flashing the same file
+# again (on another board, say) does not parse it at all.  Only the plans
+# for the KEEP_PLANS most recently used files are kept.
+#
+
+import hashlib
+import json
+import os
+import zlib
+import pyHostCache
+
+ERASED_BYTE = 0xff # Same as pyMicromem
+PLAN_VERSION = 1 # Change this if the plan layout (or what goes into it) changes
+KEEP_PLANS = 20 # Plans for the most recently used image files are kept
+
+class FirmwareImage(object):
+    'An image split into flash pages'
+
+    def __init__(self,pageSize=0x100):
+        self.pageSize = pageSize
+        self.slots = {}         # Page address -> slot number
+        self.data = bytearray() # Slot n is at n*pageSize
+        self.covered = bytearray()
+        self.symbols = {}
+        self.crcs = {}          # Page address -> CRC, worked out when asked for
+
+    def _Slot(self,pageAddress):
+        slot = self.slots.get(pageAddress)
+        if(slot is None):
+            slot = len(self.slots)
+            self.slots[pageAddress] = slot
+            self.data += bytes([ERASED_BYTE])*self.pageSize
+            self.covered += bytes(self.pageSize)
+        return slot*self.pageSize
+
+    def AddBlock(self,data,address):
+        # Copy data into the pages it falls in, a page-sized slice at a time
+        data = memoryview(data)
+        done = 0
+        while done < len(data):
+            thisAddr = address+done
+            offset = thisAddr % self.pageSize
+            length = min(len(data)-done,self.pageSize-offset)
+            pageAddress = thisAddr-offset
+            start = self._Slot(pageAddress)+offset
+            self.data[start:start+length] = data[done:done+length]
+            self.covered[start:start+length] = b'\x01'*length
+            self.crcs.pop(pageAddress,None)
+            done += length
+
+    def Repaged(self,pageSize):
+        "The same image split into pages of pageSize (itself if it already is)"
+        if(pageSize == self.pageSize):
+            return self
+        image = FirmwareImage(pageSize)
+        for pageAddress in self.PageAddresses():
+            for address,data in self.IterRuns(pageAddress):
+                image.AddBlock(data,address)
+        image.symbols = dict(self.symbols)
+        return image
+
+    def GetSymbol(self,symbol):
+        return self.symbols.get(symbol)
+
+    def GetSymbols(self,names):
+        return [self.GetSymbol(name) for name in names]
+
+    def PageAddresses(self):
+        "The address of every page in the image, in order"
+        return sorted(self.slots)
+
+    def GetPage(self,pageAddress):
+        "(data,covered) views for one page"
+        start = self.slots[pageAddress]*self.pageSize
+        return (memoryview(self.data)[start:start+self.pageSize],
+                memoryview(self.covered)[start:start+self.pageSize])
+
+    def IterPages(self):
+        # Yield (address,data,covered) for each page, in address order
+        for pageAddress in self.PageAddresses():
+            yield (pageAddress,)+self.GetPage(pageAddress)
+
+    def IterRuns(self,pageAddress):
+        # Yield (address,data) for each stretch of bytes the image has in
+        # one page; a page the image fills is just one run
+        data,covered = self.GetPage(pageAddress)
+        covered = covered.tobytes()
+        start = covered.find(1)
+        while start >= 0:
+            end = covered.find(0,start)
+            if(end < 0):
+                end = self.pageSize
+            yield pageAddress+start,data[start:end]
+            start = covered.find(1,end)
+
+    def IsFull(self,pageAddress):
+        "True if the image has every byte of the page"
+        return self.GetPage(pageAddress)[1].tobytes().find(0) < 0
+
+    def IsErased(self,pageAddress):
+        "True if the image fills the page with erased bytes"
+        data,covered = self.GetPage(pageAddress)
+        return self.IsFull(pageAddress) and data.tobytes().count(ERASED_BYTE) == self.pageSize
+
+    def PageCRC(self,pageAddress):
+        "zlib CRC-32 of the page as the image has it (uncovered bytes erased)"
+        crc = self.crcs.get(pageAddress)
+        if(crc is None):
+            crc = zlib.crc32(self.GetPage(pageAddress)[0])
+            self.crcs[pageAddress] = crc
+        return crc
+
+    def Digest(self):
+        "SHA-256 (as hex) of what the image puts where"
+        digest = hashlib.sha256(repr((self.pageSize,self.PageAddresses())).encode())
+        for pageAddress,data,covered in self.IterPages():
+            digest.update(data)
+            digest.update(covered)
+        return digest.hexdigest()
+
+    def ToBinary(self,maxSize=None):
+        # Flatten the image into one contiguous buffer, the way objcopy -O
+        # binary would: it starts at the lowest address the image has and
+        # ends at the highest, and any gaps are erased bytes.  Returns
+        # (base address,bytearray).  Raises ValueError if that would be
+        # more than maxSize bytes.
+        pages = self.PageAddresses()
+        if(not pages):
+            return None,bytearray()
+        low = pages[0]+self.GetPage(pages[0])[1].tobytes().find(1)
+        high = pages[-1]+self.GetPage(pages[-1])[1].tobytes().rfind(1)
+        if(maxSize is not None and high+1-low > maxSize):
+            raise ValueError('Image from '+hex(low)+' to '+hex(high)+
+                             ' is too big to send as one binary')
+        binary = bytearray([ERASED_BYTE])*(high+1-low)
+        for pageAddress in pages:
+            for address,data in self.IterRuns(pageAddress):
+                binary[address-low:address-low+len(data)] = data
+        return low,binary
+
+    def Save(self,path):
+        # Write the image as a flash plan: one line of JSON describing it,
+        # then the page slots, then the coverage masks.  Written to a
+        # temporary file first so a crash never leaves half a plan.
+        pages = sorted(self.slots,key=self.slots.get) # In slot order
+        header = {'version':PLAN_VERSION,'pageSize':self.pageSize,
+                  'pages':[hex(page) for page in pages],
+                  'crcs':[self.PageCRC(page) for page in pages],
+                  'symbols':self.symbols}
+        def Write(file):
+            file.write(json.dumps(header).encode()+b'\n')
+            file.write(self.data)
+            file.write(self.covered)
+        pyHostCache.WriteAtomically(path,Write,'wb')
+
+    def Stats(self):
+        # Counts for planning and reporting
+        pages = self.PageAddresses()
+        full = [page for page in pages if self.IsFull(page)]
+        return {'pages':len(pages),'fullPages':len(full),
+                'partialPages':len(pages)-len(full),
+                'erasedPages':len([page for page in full if self.IsErased(page)]),
+                'bytes':self.covered.count(1),
+                'low':pages[0] if pages else None,
+                'high':pages[-1]+self.pageSize-1 if pages else None}
+
+
+def Load(path):
+    "Read a plan written by FirmwareImage.Save; None if it is not usable"
+    try:
+        with open(path,'rb') as file:
+            header = json.loads(file.readline())
+            if(header.get('version') != PLAN_VERSION):
+                return None
+            image = FirmwareImage(header['pageSize'])
+            length = len(header['pages'])*image.pageSize
+            image.data = bytearray(file.read(length))
+            image.covered = bytearray(file.read(length))
+    except (OSError,ValueError,KeyError):
+        return None
+    if(len(image.data) != length or len(image.covered) != length):
+        return None # Cut short
+    pages = [int(page,16) for page in header['pages']]
+    image.slots = {page:slot for slot,page in enumerate(pages)}
+    image.crcs = dict(zip(pages,header['crcs']))
+    image.symbols = header['symbols']
+    return image
+
+def _PlanPath(fileName,pageSize,base,symbolNames):
+    # The plan depends on the file contents and on how we were asked to
+    # read it, so all of that goes into the name
+    digest = hashlib.sha256()
+    with open(fileName,'rb') as file:
+        for chunk in iter(lambda: file.read(1<<20),b''):
+            digest.update(chunk)
+    digest.update(repr((PLAN_VERSION,pageSize,base,list(symbolNames))).encode())
+    return os.path.join(pyHostCache.CacheDir('plans'),digest.hexdigest()+'.plan')
+
+def CachedFromFile(fileName,pageSize=0x100,base=None,symbolNames=()):
+    # Like FromFile, but use the saved plan if this file has been read
+    # before, and save one if it has not.  Returns (image,True) if the plan
+    # came from the cache, or (image,False) if the file was parsed.
+    try:
+        path = _PlanPath(fileName,pageSize,base,symbolNames)
+        image = Load(path)
+    except OSError:
+        # No usable cache directory; we can still flash, just without a plan
+        return FromFile(fileName,pageSize,base,symbolNames),False
+    if(image is not None):
+        try:
+            os.utime(path) # Recently used, so _PrunePlans keeps it
+        except OSError:
+            pass
+        return image,True
+    image = FromFile(fileName,pageSize,base,symbolNames)
+    try:
+        image.Save(path)
+        _PrunePlans(os.path.dirname(path))
+    except OSError:
+        pass # We can still flash; it just will not be quicker next time
+    return image,False
+
+def _PrunePlans(directory,keep=KEEP_PLANS):
+    # Every new image file (each nightly build, say) adds a plan, so only
+    # keep the ones used most recently
+    plans = []
+    for name in os.listdir(directory):
+        if(not name.endswith('.plan')):
+            continue # Such as one being written right now
+        path = os.path.join(directory,name)
+        try:
+            plans.append((os.path.getmtime(path),path))
+        except OSError:
+            pass # Removed by another pyMicroloader
+    for mtime,path in sorted(plans,reverse=True)[keep:]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def FromFile(fileName,pageSize=0x100,base=None,symbolNames=()):
+    # Build a FirmwareImage from any image file pyImageFile can open.
+    # base is only used for raw binaries.  The addresses of symbolNames
+    # are kept (None for any the file does not have).
+    import pyImageFile
+    image = FirmwareImage(pageSize)
+    with pyImageFile.OpenImage(fileName,base) as imageFile:
+        for address,data in imageFile.IterCode():
+            image.AddBlock(data,address)
+        image.symbols = dict(zip(symbolNames,imageFile.GetSymbols(symbolNames)))
+    return image
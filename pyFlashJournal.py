@@ -0,0 +1,134 @@
+# /* Copyright (C) 2026 Burns Fisher
+#  * 
+#  * This program is free software; you can redistribute it and/or modify
+#  * it under the terms of the GNU General Public License as published by
+#  * the Free Software Foundation; either version 2 of the License, or
+#  * (at your option) any later version.
+#  *
+#  * This program is distributed in the hope that it will be useful,
+#  * but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  * GNU General Public License for more details.
+#  *
+#  * You should have received a copy of the GNU General Public License along
+#  * with this program; if not, write to the Free Software Foundation, Inc.,
+#  * 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#  * 
+#  */
+
+#
+# This module keeps a journal, on the host, of the pages written so far
+# while flashing an image to a board.  pyMicromem adds a line to it as each
+# page is written, so if the board resets or the USB adapter drops out
+# part way through, "pyMicroloader --resume" can carry on from the first
+# page that was not written instead of starting again.
+#
+# The journal is a text file: one line of JSON saying which image (a hash
+# of the FirmwareImage) was going to which board (serial number, or the
+# port it is on if the image has no serial number), then one
+# line per page with its address and the CRC-32 of what was written.  A
+# line cut short by a crash is ignored.  The journal is removed once the
+# flash has been compared.
+#
+
+import json
+import os
+import re
+import zlib
+import pyHostCache
+
+class FlashJournal(object):
+    'Record of the pages written so far in one flash of one board'
+
+    def __init__(self,imageDigest,serial,pageSize,device=None):
+        # device (the loader's port) tells boards apart when there is no
+        # serial number, so that boards flashed at the same time (--all)
+        # each have their own journal
+        self.imageDigest = imageDigest
+        self.serial = serial
+        self.pageSize = pageSize
+        self.device = device if serial is None else None
+        if(serial is not None):
+            name = str(serial)
+        else:
+            name = 'port-'+re.sub(r'[^A-Za-z0-9]+','_',str(device)).strip('_')
+        self.path = os.path.join(pyHostCache.CacheDir('journal'),name+'.journal')
+        self.pages = {} # Page address -> CRC-32 of what was written
+        self.resumePages = {} # What Load found, which this flash can skip
+        self.file = None
+
+    def _Header(self):
+        return {'image':self.imageDigest,'serial':self.serial,'device':self.device,
+                'pageSize':self.pageSize}
+
+    def Load(self):
+        # Read the pages an earlier flash of this same image to this board
+        # got written before it stopped.  Returns how many there are (0 if
+        # the journal is missing or for something else).
+        self.pages = {}
+        self.resumePages = {}
+        try:
+            with open(self.path,'r') as file:
+                if(json.loads(file.readline()) != self._Header()):
+                    return 0
+                for line in file:
+                    fields = line.split()
+                    if(not line.endswith('\n') or len(fields) != 2):
+                        break # The write that was going on when we stopped
+                    self.pages[int(fields[0],16)] = int(fields[1],16)
+        except (OSError,ValueError):
+            self.pages = {}
+        self.resumePages = dict(self.pages)
+        return len(self.pages)
+
+    def Confirm(self,loader,count=2):
+        # Before trusting the journal, make sure the device has the pages it
+        # says were written.  If not, forget everything so that the whole
+        # image is written.
+        if(len(self.pages) == 0):
+            return False
+        addr = pyHostCache.FirstMismatch(loader,self.pages,self.pageSize,
+                                         zlib.crc32,count)
+        if(addr is not None):
+            print("\nJournal for serial "+str(self.serial)+
+                  " does not match device at "+hex(addr)+"; writing all pages")
+            self.pages = {}
+            self.resumePages = {}
+            return False
+        return True
+
+    def Written(self,address,contents):
+        "True if the flash being resumed wrote this page with these contents"
+        return self.resumePages.get(address) == zlib.crc32(contents)
+
+    def Start(self):
+        # Begin a new journal holding what we already know (nothing, unless
+        # Load found an earlier flash to resume) and keep it open to add to
+        self.Close()
+        def Write(file):
+            file.write(json.dumps(self._Header())+'\n')
+            for addr in sorted(self.pages):
+                file.write('%x %08x\n' % (addr,self.pages[addr]))
+        pyHostCache.WriteAtomically(self.path,Write)
+        self.file = open(self.path,'a')
+
+    def Add(self,address,contents):
+        "Note that a page is now on the device"
+        crc = zlib.crc32(contents)
+        self.pages[address] = crc
+        if(self.file is not None):
+            self.file.write('%x %08x\n' % (address,crc))
+            self.file.flush() # So it survives us being killed
+
+    def Close(self):
+        if(self.file is not None):
+            self.file.close()
+            self.file = None
+
+    def Remove(self):
+        "The flash is finished; nothing to resume"
+        self.Close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
@@ -0,0 +1,80 @@
+# /* Copyright (C) 2026 Burns Fisher
+#  * 
+#  * This program is free software; you can redistribute it and/or modify
+#  * it under the terms of the GNU General Public License as published by
+#  * the Free Software Foundation; either version 2 of the License, or
+#  * (at your option) any later version.
+#  *
+#  * This program is distributed in the hope that it will be useful,
+#  * but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  * GNU General Public License for more details.
+#  *
+#  * You should have received a copy of the GNU General Public License along
+#  * with this program; if not, write to the Free Software Foundation, Inc.,
+#  * 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#  * 
+#  */
+
+#
+# Small helpers for the files that pyMicroloader keeps on the host between
+# runs.  Everything lives under ~/.pyMicroloader (or the directory named by
+# the PYMICROLOADER_CACHE environment variable) so it is easy to find and
+# easy to throw away.
+#
+
+import json
+import os
+import tempfile
+
+def CacheDir(name):
+    "Return (and create if needed) a subdirectory of the host cache"
+    base = os.environ.get('PYMICROLOADER_CACHE')
+    if base is None:
+        base = os.path.join(os.path.expanduser('~'),'.pyMicroloader')
+    path = os.path.join(base,name)
+    os.makedirs(path,exist_ok=True)
+    return path
+
+def LoadJson(path,default=None):
+    "Read a JSON cache file.  A missing or damaged file gives the default"
+    try:
+        with open(path,'r') as file:
+            return json.load(file)
+    except (OSError,ValueError):
+        return default
+
+def WriteAtomically(path,write,mode='w'):
+    # Call write(file) on a new temporary file next to path, then move it
+    # over path, so that a crash never leaves half a file behind.  The
+    # temporary name is unique, so several pyMicroloaders (one per board,
+    # say) can write the same cache file at once; the last one wins.
+    fd,tempPath = tempfile.mkstemp(dir=os.path.dirname(path),
+                                   prefix=os.path.basename(path)+'.',suffix='.tmp')
+    try:
+        with os.fdopen(fd,mode) as file:
+            write(file)
+        os.replace(tempPath,path)
+    except BaseException:
+        try:
+            os.remove(tempPath)
+        except OSError:
+            pass
+        raise
+
+def SaveJson(path,value):
+    "Write a JSON cache file so that a crash never leaves half a file behind"
+    WriteAtomically(path,lambda file: json.dump(value,file))
+
+def FirstMismatch(loader,pages,pageSize,hashFunction,count):
+    # Before trusting a record of what is on a device (pages maps each page
+    # address to hashFunction of its contents), read back count of those
+    # pages, the first and the last among them as the last is the one most
+    # likely to have been hit, and the rest spread between.  Returns the
+    # address of the first that does not match, or None if they all do.
+    addresses = sorted(pages)
+    step = max(1,(len(addresses)-1)//max(1,count-1))
+    for addr in sorted(set(addresses[::step][:count-1]+[addresses[-1]])):
+        if(hashFunction(loader.ReadPage(addr,pageSize)) != pages[addr]):
+            return addr
+    return None
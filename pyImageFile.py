@@ -0,0 +1,240 @@
+# /* Copyright (C) 2026 Burns Fisher
+#  *
+#  * This program is free software; you can redistribute it and/or modify
+#  * it under the terms of the GNU General Public License as published by
+#  * the Free Software Foundation; either version 2 of the License, or
+#  * (at your option) any later version.
+#  *
+#  * This program is distributed in the hope that it will be useful,
+#  * but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  * GNU General Public License for more details.
+#  *
+#  * You should have received a copy of the GNU General Public License along
+#  * with this program; if not, write to the Free Software Foundation, Inc.,
+#  * 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#  *
+#  */
+
+#
+# Firmware image files.  Everything pyMicroloader loads is an ImageFile,
+# which gives it the code to load as (address,data) pairs and, if the file
+# has them, symbol addresses.  SimpleElf (in pySimpleElf) is one; this
+# module has the others:
+#
+#   IntelHexFile   Intel HEX (.hex)
+#   SRecordFile    Motorola S-records (.srec, .s19, .s28, .s37, .mot)
+#   BinaryFile     Raw binary, which needs to be told its base address
+#
+# The text formats are read a line at a time as IterCode goes, so a big
+# file is never all in memory at once.  OpenImage picks the right class
+# from the file name (or, failing that, the first few bytes).
+#
+
+import mmap
+import os
+
+class ImageFile(object):
+    'What pyMicroloader needs from a firmware image'
+
+    def IterCode(self):
+        # Yield (address,data) for each piece of the image, where data is
+        # anything bytes-like.  Pieces that follow on from each other may
+        # come out as one.
+        raise NotImplementedError
+
+    def GetSymbol(self,symbol):
+        "Address of symbol, or None if the file does not have it"
+        return None
+
+    def GetSymbols(self,names):
+        "Returns the values of all the symbols in names (None if not found)"
+        return [self.GetSymbol(name) for name in names]
+
+    def Close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.Close()
+
+
+class _TextImageFile(ImageFile):
+    # Common part of the formats that are lines of hex text
+
+    def __init__(self,file):
+        # file is a file name or a file already opened (text or binary)
+        if(isinstance(file,(str,bytes,os.PathLike))):
+            self.file = open(file,'rb')
+            self.ownFile = True
+        else:
+            self.file = file
+            self.ownFile = False
+        self.name = getattr(self.file,'name','image')
+
+    def Close(self):
+        if(self.ownFile):
+            self.file.close()
+
+    def _Lines(self):
+        # Yield (line number,bytes of the record) for each record
+        self.file.seek(0)
+        for number,line in enumerate(self.file,1):
+            if(isinstance(line,str)):
+                line = line.encode()
+            line = line.strip()
+            if(line):
+                yield number,line
+
+    def _Error(self,number,message):
+        return ValueError(str(self.name)+' line '+str(number)+': '+message)
+
+    def _Records(self):
+        # Yield (line number,address,data) for each data record in order
+        raise NotImplementedError
+
+    def IterCode(self):
+        # Records are usually one after another, so collect them into
+        # runs and only hand out a run when the next record does not
+        # follow on from it
+        address = None
+        run = bytearray()
+        for number,recordAddress,data in self._Records():
+            if(address is not None and recordAddress == address+len(run)):
+                run += data
+                continue
+            if(run):
+                yield address,run
+            address = recordAddress
+            run = bytearray(data)
+        if(run):
+            yield address,run
+
+
+class IntelHexFile(_TextImageFile):
+    'An Intel HEX file'
+
+    def _Records(self):
+        upper = 0 # From extended segment (02) or linear (04) address records
+        for number,line in self._Lines():
+            if(not line.startswith(b':')):
+                raise self._Error(number,'does not start with ":"')
+            try:
+                record = bytes.fromhex(line[1:].decode())
+            except ValueError:
+                raise self._Error(number,'is not hex')
+            if(len(record) < 5 or len(record) != record[0]+5):
+                raise self._Error(number,'has the wrong length')
+            if(sum(record) & 0xff):
+                raise self._Error(number,'has a bad checksum')
+            offset = int.from_bytes(record[1:3],'big')
+            recordType = record[3]
+            data = record[4:-1]
+            if(recordType == 0x00):
+                yield number,upper+offset,data
+            elif(recordType == 0x01):
+                return # End of file
+            elif(recordType == 0x02):
+                upper = int.from_bytes(data,'big') << 4
+            elif(recordType == 0x04):
+                upper = int.from_bytes(data,'big') << 16
+            elif(recordType in (0x03,0x05)):
+                pass # Start address; the loader starts the code itself
+            else:
+                raise self._Error(number,'has unknown record type '+hex(recordType))
+
+
+class SRecordFile(_TextImageFile):
+    'A Motorola S-record file'
+
+    # Bytes of address for each record type that has one
+    addressLength = {b'0':2,b'1':2,b'2':3,b'3':4,b'5':2,b'6':3,b'7':4,b'8':3,b'9':2}
+
+    def _Records(self):
+        for number,line in self._Lines():
+            recordType = line[1:2]
+            if(not line.startswith(b'S') or recordType not in self.addressLength):
+                raise self._Error(number,'is not an S-record')
+            try:
+                record = bytes.fromhex(line[2:].decode())
+            except ValueError:
+                raise self._Error(number,'is not hex')
+            if(len(record) < 1 or len(record) != record[0]+1):
+                raise self._Error(number,'has the wrong length')
+            if((sum(record) & 0xff) != 0xff):
+                raise self._Error(number,'has a bad checksum')
+            length = self.addressLength[recordType]
+            if(recordType in (b'1',b'2',b'3')):
+                yield number,int.from_bytes(record[1:1+length],'big'),record[1+length:-1]
+            elif(recordType in (b'7',b'8',b'9')):
+                return # Start address, which is the end of the data
+            # S0 is a header and S5/S6 a record count; neither is loaded
+
+
+class BinaryFile(ImageFile):
+    'A raw binary file, which is loaded starting at base'
+
+    def __init__(self,file,base):
+        if(base is None):
+            raise ValueError('A binary file needs a base address (--base)')
+        self.base = base
+        self.map = None
+        if(isinstance(file,(str,bytes,os.PathLike))):
+            with open(file,'rb') as realFile:
+                if(os.fstat(realFile.fileno()).st_size):
+                    self.map = mmap.mmap(realFile.fileno(),0,access=mmap.ACCESS_READ)
+                    self.image = memoryview(self.map)
+                else:
+                    self.image = memoryview(b'')
+        else:
+            file.seek(0)
+            self.image = memoryview(file.read())
+
+    def IterCode(self):
+        if(len(self.image)):
+            yield self.base,self.image[:] # A view of its own, so Close can release ours
+
+    def Close(self):
+        # As with SimpleElf, the mapping stays if the data is still in use
+        self.image.release()
+        if(self.map is not None):
+            try:
+                self.map.close()
+            except BufferError:
+                pass
+            self.map = None
+
+
+_extensions = {'.elf':'elf','.axf':'elf','.out':'elf',
+               '.hex':'hex','.ihex':'hex','.ihx':'hex',
+               '.srec':'srec','.s19':'srec','.s28':'srec','.s37':'srec','.mot':'srec',
+               '.bin':'bin'}
+
+def ImageType(fileName):
+    "'elf', 'hex', 'srec' or 'bin', from the file name or its first bytes"
+    imageType = _extensions.get(os.path.splitext(fileName)[1].lower())
+    if(imageType is not None):
+        return imageType
+    with open(fileName,'rb') as file:
+        start = file.read(4)
+    if(start == b'\x7fELF'):
+        return 'elf'
+    if(start[:1] == b':'):
+        return 'hex'
+    if(start[:1] == b'S' and start[1:2].isdigit()):
+        return 'srec'
+    return 'bin'
+
+def OpenImage(fileName,base=None):
+    "Open any kind of image file; base is only used for raw binaries"
+    imageType = ImageType(fileName)
+    if(imageType == 'elf'):
+        import pySimpleElf # Only load pyelftools if we need it
+        return pySimpleElf.SimpleElf(fileName)
+    if(imageType == 'hex'):
+        return IntelHexFile(fileName)
+    if(imageType == 'srec'):
+        return SRecordFile(fileName)
+    return BinaryFile(fileName,base)
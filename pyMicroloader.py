@@ -1,10 +1,13 @@
 import os
 import sys
 import threading
-import traceback
 import time
-import pyMicromem
-import pySimpleElf
+startTime = time.perf_counter()
+# Only what every loader needs is imported here; pyFirmwareImage,
+# pySimpleElf (which pulls in pyelftools) and pyMicromem are imported when
+# they are first used.  So an image that has been read before never loads
+# pyelftools, and the TI loader never loads pyMicromem.
+import pyPortScan
 
 forceSerialNumber = False
 specifiedSerialNumber=False
@@ -12,6 +15,12 @@ waitForDevice=False
 altosLoader=True
 uartLoader=False
 tiUartLoader = False
+deltaMode = False
+multiTarget = False
+timingReport = False
+resumeMode = False
+baudRate = None
+baseAddress = None
 portName=None
 if len(sys.argv)==1:
     elffile='test.elf'
@@ -41,9 +50,24 @@ for i in range(2,len(sys.argv)):
     elif '--ti-uart' in sys.argv[i]:
         tiUartLoader = True
         altosLoader = False
+    elif '--delta' in sys.argv[i]:
+        deltaMode = True
+    elif '--resume' in sys.argv[i]:
+        resumeMode = True
+    elif '--all' in sys.argv[i]:
+        multiTarget = True
+    elif '--timing' in sys.argv[i]:
+        timingReport = True
+    elif '--base' in sys.argv[i]:
+        skip=i+1
+        baseAddress=int(sys.argv[skip],0)
+    elif '--baud' in sys.argv[i]:
+        skip=i+1
+        baudRate=int(sys.argv[skip])
     else:
         print("\npyMicroloader V2.3--Usage:\n")
         print("  python pyMicroloader.py filename [--serial n] [--force]\n")
+        print("     filename is an ELF, Intel HEX, S-record or raw binary file")
         print("     --serial is optional if the device has been flashed before;")
         print("       otherwise, you must specify it.  If you specified serial")
         print("       it must match the serial already flashed unless --force")
@@ -54,7 +78,22 @@ for i in range(2,len(sys.argv)):
         print("    --usb uses the Altos USB flash loader protocol")
         print("    --uart uses the AMSAT serial flash loader protocol")
         print("    --ti-uart uses the ymodem flash loader protocol for TI MCUs")
+        print("    --delta only writes pages that changed since this board was")
+        print("       last flashed from this computer")
+        print("    --resume carries on from where a flash of the same image")
+        print("       to this board stopped (if the board reset, say)")
+        print("    --all flashes every board found, at the same time.  Each")
+        print("       board keeps the serial number already in it; with")
+        print("       --serial n, boards never flashed get n, n+1, ...")
+        print("    --baud n asks a UART loader to switch to n baud instead of")
+        print("       the fastest rate it will take")
+        print("    --base addr is the address to load a raw binary file at")
+        print("    --timing prints how long startup, parsing, connecting and")
+        print("       flashing took")
         sys.exit()
+if multiTarget and portName != None:
+    print("--all cannot be used with --port")
+    sys.exit(1)
 if altosLoader:
     import pyAltosFlash as ldr
     print("Using Altos USB Flash Loader")
@@ -68,37 +107,93 @@ else:
     print("No loader specified")
     sys.exit()
 
-retry = True
-while retry:
+phaseTimes = []
+lastMark = startTime
+def Mark(phase):
+    # Note how long the phase that just finished took, for --timing
+    global lastMark
+    now = time.perf_counter()
+    phaseTimes.append((phase,now-lastMark))
+    lastMark = now
+
+def PrintTiming():
+    if not timingReport:
+        return
+    print("\nTiming:")
+    for phase,seconds in phaseTimes:
+        print("  %-10s %8.3f s" % (phase,seconds))
+    print("  %-10s %8.3f s" % ('total',time.perf_counter()-startTime))
+
+Mark('startup')
+
+# The serial number and the two romconfig words
+SERIAL_SYMBOLS = ['ao_serial_number','ao_romconfig_version','ao_romconfig_check']
+
+def ReadImage(elffile,defaultBase=None):
+    # Read the image file once into a FirmwareImage, laid out in flash
+    # pages, along with the addresses of SERIAL_SYMBOLS (None if the image
+    # does not have them, as only ELF files have symbols).  A raw binary
+    # goes at --base, or defaultBase if that was not given.
+    # If this very file has been read before, the plan saved then is used
+    # and the file is not parsed at all.
+    import pyFirmwareImage
+    base = baseAddress if baseAddress != None else defaultBase
+    image,cached = pyFirmwareImage.CachedFromFile(elffile,base=base,
+                                                  symbolNames=SERIAL_SYMBOLS)
+    if cached:
+        print("Using the flash plan saved when this image was last read")
+    stats = image.Stats()
+    print("Image has "+str(stats['bytes'])+" bytes in "+str(stats['pages'])+" pages ("+
+          str(stats['partialPages'])+" partly filled, "+str(stats['erasedPages'])+" erased)")
+    return image
+
+def ReadImageOrExit(defaultBase=None):
     try:
-        print("Try loader")
-        loader = ldr.FlashLdr(device=portName,debug=True) # Connect to the MCU
-        retry = False
+        image = ReadImage(elffile,defaultBase)
     except ValueError as er:
         print(er)
-        retry = waitForDevice
-        if retry:
-            print("Retrying in 5 sec...")
-            time.sleep(5)
-        else:
-            sys.exit()
+        sys.exit(1)
+    Mark('parse')
+    return image
 
-# The flow for TI MCUs is different as it uses ymodem protocol
-# for reliable delivery of the code, from a binary file instead
-# the .elf used by other MCUs
-if tiUartLoader:
-    loader.download_application(elffile)
-    loader.StartExecution()
-    sys.exit(0)
+def FlashBoard(loader,image,inputSerialNumber=None,newSerial=None):
+    # Load the image into the board on the other end of loader and start
+    # it.  inputSerialNumber is the one from the command line, if any.
+    # newSerial, if given, is called to get a serial number for a board
+    # that has not been flashed before (for --all).
+    # Returns the serial number that was flashed.  Raises ValueError if the
+    # board should not be flashed.
 
+    # Loaders that can change baud rate are moved to a faster one first
+    loader.NegotiateBaud(baudRate)
 
-ihu = pyMicromem.Device(loader.GetLowAddr(),loader.GetHighAddr(),loader)
+    # The flow for TI MCUs is different as it uses ymodem protocol
+    # for reliable delivery of the code.  The loader takes one binary
+    # that starts at the bottom of its flash, so the image is flattened
+    # into that in memory.  A raw binary file is assumed to start there.
+    if tiUartLoader:
+        size = loader.GetHighAddr()+1-loader.GetLowAddr()
+        base,binary = image.ToBinary(size)
+        if base != loader.GetLowAddr():
+            raise ValueError("Image starts at "+hex(base)+" but the loader's flash starts at "+
+                             hex(loader.GetLowAddr()))
+        if not loader.download_image(os.path.basename(elffile),binary):
+            raise ValueError("Download failed")
+        if timingReport:
+            counters = loader.transfer_counters
+            print("ymodem: %d bytes out in %d writes, %d bytes in in %d reads, "
+                  "%d waits for the loader (%.3f s)" %
+                  (counters['bytes_written'],counters['writes'],counters['bytes_read'],
+                   counters['reads'],counters['stalls'],counters['stall_seconds']))
+        loader.StartExecution()
+        return None
 
-with open(elffile,'rb') as file:
-    datafile = pySimpleElf.SimpleElf(file)
-    pSerialNumber = datafile.GetSymbol('ao_serial_number')
-    pConfigVersion= datafile.GetSymbol('ao_romconfig_version')
-    pConfigCheck = datafile.GetSymbol('ao_romconfig_check')
+    import pyMicromem
+    # The image was read before we knew the loader; lay it out in the
+    # loader's pages if they are not the usual size
+    image = image.Repaged(loader.GetPageSize())
+    ihu = pyMicromem.Device(loader.GetLowAddr(),loader.GetHighAddr(),loader)
+    pSerialNumber,pConfigVersion,pConfigCheck = image.GetSymbols(SERIAL_SYMBOLS)
     if(pSerialNumber != None and pConfigVersion!=None and pConfigCheck != None):
         deviceSerial = ihu.GetInt32(pSerialNumber)
         deviceConfig = ihu.GetInt16(pConfigVersion)
@@ -106,12 +201,11 @@ with open(elffile,'rb') as file:
         if(deviceConfig == (~deviceConfigChk & 0xFFFF)):
             # Has been flashed before
             print("\nDevice with serial number "+str(deviceSerial)+" has been loaded before")
-            if (specifiedSerialNumber):
+            if (inputSerialNumber != None):
                 if(deviceSerial != inputSerialNumber):
                     if(not forceSerialNumber):
                         #If there actually WAS a serial number specified, it is wrong
-                        print('Incorrect Serial Number specified. If correct, use --force)')
-                        sys.exit(1)
+                        raise ValueError('Incorrect Serial Number specified. If correct, use --force)')
                     else:
                         print("--force used to change the serial number")
                 #else:
@@ -121,27 +215,157 @@ with open(elffile,'rb') as file:
                 inputSerialNumber = deviceSerial
         else:
             # Not flashed before
-            if(not specifiedSerialNumber):
-                print("This processor has not been flashed.  You must specify a serial number")
-                sys.exit(1)
+            if(inputSerialNumber == None and newSerial != None):
+                inputSerialNumber = newSerial()
+            if(inputSerialNumber == None):
+                raise ValueError("This processor has not been flashed.  You must specify a serial number")
             else:
                 print("This processor has not been flashed. Using serial number "+str(inputSerialNumber))
 
-    while True:
-        toFlash = datafile.GetCode()
-        if toFlash == None:
-            break
-
-        for i in range(0,toFlash[2]):
-            thisAddr = toFlash[1]+i
-            ihu.PutByte(toFlash[0][i],thisAddr)
-    ihu.PutInt16(inputSerialNumber,pSerialNumber)
+    ihu.LoadImage(image)
+    if pSerialNumber == None:
+        print("No serial number in this image; it is loaded as it is")
+    elif inputSerialNumber != None:
+        ihu.PutInt16(inputSerialNumber,pSerialNumber)
+    if deltaMode:
+        if pSerialNumber == None:
+            print("No serial number in this image; --delta ignored")
+        else:
+            import pyDeltaCache
+            try:
+                cache = pyDeltaCache.DeltaCache(inputSerialNumber,loader.GetPageSize())
+            except OSError as er:
+                print("Cannot use the delta cache ("+str(er)+"); --delta ignored")
+            else:
+                cache.Confirm(loader)
+                ihu.SetDeltaCache(cache)
+    # Note each page as it is written, so that a flash that stops part way
+    # can be picked up again with --resume
+    import pyFlashJournal
+    try:
+        journal = pyFlashJournal.FlashJournal(image.Digest(),inputSerialNumber,
+                                              loader.GetPageSize(),loader.GetDevice())
+        if resumeMode:
+            if journal.Load() == 0:
+                print("Nothing to resume for this image and board; writing all pages")
+            elif journal.Confirm(loader):
+                print("Resuming: "+str(len(journal.resumePages))+" pages were written before")
+        journal.Start()
+        ihu.SetJournal(journal)
+    except OSError as er:
+        # We can still flash; it just cannot be resumed if it stops
+        print("Cannot keep a flash journal ("+str(er)+")")
+        journal = None
     ihu.MemoryFlush()
+    if ihu.deltaCache is not None:
+        print("\nDelta: wrote "+str(ihu.pagesWritten)+" pages, skipped "+
+              str(ihu.pagesSkipped)+" unchanged pages")
+    if ihu.pagesResumed:
+        print("\nResume: skipped "+str(ihu.pagesResumed)+" pages already written")
+    if ihu.pagesElided:
+        print("\nSkipped "+str(ihu.pagesElided)+" erased pages ("+
+              str(ihu.bytesElided)+" bytes) that were already erased on the device")
     print("\nLoaded.  Starting compare.")
-    ihu.MemoryCompare()
+    failures = ihu.MemoryCompare()
+    if journal is not None:
+        journal.Remove() # Finished, and either good or not to be trusted
+    if ihu.deltaCache is not None:
+        # Only keep hashes for what the compare found on the device
+        for first,last in failures:
+            ihu.deltaCache.Forget(first,last)
+        ihu.deltaCache.Save()
+    if failures:
+        raise ValueError("Compare failed")
     print("Done--starting execution")
     time.sleep(1)
     loader.StartExecution()
+    if not multiTarget:
+        # Remember which board was on this port for next time
+        pyPortScan.RememberPort(ldr.LOADER_TYPE,loader.GetDevice(),
+                                serial=inputSerialNumber)
+    return inputSerialNumber
+
+def FlashAll(image):
+    # Flash every board we can find, each on its own thread.  The image
+    # is parsed once and shared by all of them.
+    loaders = ldr.FindLoaders(findAll=True)
+    if not loaders:
+        print("No loaders found")
+        sys.exit(1)
+    if image == None:
+        # A TI raw binary starts at the bottom of flash, which we only
+        # know once there is a loader to ask
+        image = ReadImageOrExit(loaders[0].GetLowAddr())
+    ports = [loader.GetDevice() for loader in loaders]
+    results = {}
+    # With --serial n, boards that have not been flashed get n, n+1, ...
+    # in the order they are found to be blank.  The others keep theirs.
+    serialLock = threading.Lock()
+    nextSerial = [inputSerialNumber if specifiedSerialNumber else None]
+    def NewSerial():
+        with serialLock:
+            serialNumber = nextSerial[0]
+            if serialNumber != None:
+                nextSerial[0] += 1
+            return serialNumber
+    def FlashOne(loader):
+        start = time.time()
+        serialNumber = None
+        try:
+            serialNumber = FlashBoard(loader,image,None,NewSerial)
+            result = 'OK'
+        except Exception as er:
+            result = 'FAILED: '+str(er)
+        results[loader.GetDevice()] = (serialNumber,result,time.time()-start)
+    threads = [threading.Thread(target=FlashOne,args=(loader,)) for loader in loaders]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    print("\n\n%-16s %-10s %8s  %s" % ('Port','Serial','Seconds','Result'))
+    for port in ports:
+        serialNumber,result,seconds = results[port]
+        print("%-16s %-10s %8.1f  %s" % (port,str(serialNumber),seconds,result))
+    if any(results[port][1] != 'OK' for port in ports):
+        sys.exit(1)
+
+image = None
+if not tiUartLoader:
+    image = ReadImageOrExit()
+
+if multiTarget:
+    FlashAll(image)
+    Mark('flash all')
+    PrintTiming()
+    sys.exit(0)
+
+retry = True
+while retry:
+    try:
+        print("Try loader")
+        loader = ldr.FlashLdr(device=portName,debug=True) # Connect to the MCU
+        retry = False
+    except ValueError as er:
+        print(er)
+        retry = waitForDevice
+        if retry:
+            print("Retrying in 5 sec...")
+            time.sleep(5)
+        else:
+            sys.exit()
+Mark('connect')
+if image == None:
+    image = ReadImageOrExit(loader.GetLowAddr())
+
+try:
+    FlashBoard(loader,image,
+               inputSerialNumber if specifiedSerialNumber else None)
+except ValueError as er:
+    print(er)
+    sys.exit(1)
+Mark('flash')
+PrintTiming()
 
 ##except ELFError as ex:
 ##    sys.stderr.write("ELF error: %s\n" % ex)
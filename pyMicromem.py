@@ -24,13 +24,25 @@
 # ST-Link dongle or even the STM32L built-in USB or serial loader.
 #
 
-import os
-import platform
 import sys
-import traceback
-import serial
-import serial.tools.list_ports
-import time
+import zlib
+
+ERASED_BYTE = 0xff # What a byte of erased flash reads as
+
+def _MismatchRanges(address,device,expected):
+    # Return [first,last] address pairs for each run of bytes that differ
+    ranges = []
+    start = None
+    for i in range(0,len(expected)):
+        if(device[i] != expected[i]):
+            if(start is None):
+                start = i
+        elif(start is not None):
+            ranges.append([address+start,address+i-1])
+            start = None
+    if(start is not None):
+        ranges.append([address+start,address+len(expected)-1])
+    return ranges
 
 class MemoryPage(object):
     'A representation of a page of memory in the microprocessor'
@@ -38,33 +50,116 @@ class MemoryPage(object):
     loaded = False
 
     def __init__(self,address,loader):
+        self.size = loader.GetPageSize()
         self.lowAddress = address & ~(self.size-1)
         self.highAddress=self.lowAddress+self.size-1;
         self.loaded = False
         self.dirty = False
+        self.modified = False # Has host data, whether or not flushed yet
+        self.elided = False # Erased on the device already, so not written
         self.loader = loader
-        self.size = loader.GetPageSize()
+        # CRC-32 of the contents if they are a full page straight from a
+        # FirmwareImage, which has it already; None once anything changes
+        self.imageCRC = None
+        # Until the page is loaded from the device, covered has a 1 for
+        # every byte that has been written by the host.  A page that is
+        # completely covered never needs to be read before it is written.
+        self.contents = None
+        self.covered = None
 
     def TestPage(self):
-        # If we have never written, don't bother.  Plus there might be no
-        # contents.
-        if(not self.dirty):
-            return
+        # Read the page back and return a list of [first,last] address
+        # ranges that do not match.  If we have never written, don't bother.
+        # Plus there might be no contents.
+        if(not self.modified):
+            return []
+        self.CompletePage()
         tempContents = self.loader.ReadPage(self.lowAddress,self.size)
-        for i in range(0,self.size):
-            if(tempContents[i] != self.contents[i]):
-                print("\nCompare fail for address="+hex(self.lowAddress+i)+': Device='+
-                      str(tempContents[i])+ ' File='+str(self.contents[i]))
+        if(tempContents == self.contents):
+            return []
+        return _MismatchRanges(self.lowAddress,tempContents,self.contents)
+
                       
     def LoadPage(self):
         self.contents = self.loader.ReadPage(self.lowAddress,self.size)
+        self.imageCRC = None
+        self.covered = None
         self.loaded = True
         self.dirty = False
-        
+        self.modified = False
+
+    def IsCovered(self,offset=0,length=None):
+        # True if every byte in the range has been written by the host (or
+        # the page has been loaded, so all the contents are known)
+        if(self.loaded):
+            return True
+        if(self.covered is None):
+            return False
+        if(length is None):
+            length = self.size-offset
+        return self.covered.find(0,offset,offset+length) < 0
+
+    def _MergePage(self):
+        # Read the page from the device and lay the bytes that the host has
+        # already written on top of it.  Only needed for pages that are
+        # partly covered.
+        deviceContents = self.loader.ReadPage(self.lowAddress,self.size)
+        start = self.covered.find(1)
+        while start >= 0:
+            end = self.covered.find(0,start)
+            if(end < 0):
+                end = self.size
+            deviceContents[start:end] = self.contents[start:end]
+            start = self.covered.find(1,end)
+        self.contents = deviceContents
+        self.covered = None
+        self.loaded = True
+
+    def _PrepareWrite(self,offset,length):
+        if(self.loaded):
+            return
+        if(self.covered is None):
+            self.contents = bytearray(self.size)
+            self.covered = bytearray(self.size)
+        self.covered[offset:offset+length] = b'\x01'*length
+
+    def _PrepareRead(self,offset,length):
+        if(self.IsCovered(offset,length)):
+            return
+        if(self.covered is None):
+            self.LoadPage()
+        else:
+            self._MergePage()
+
+    def CompletePage(self):
+        # Make sure contents holds the whole page.  Only an edge page that
+        # is partly written needs anything read from the device.
+        if(not self.IsCovered()):
+            if(self.covered is None):
+                self.LoadPage()
+            else:
+                self._MergePage()
+
+    def CRC(self):
+        "zlib CRC-32 of everything the page should hold"
+        if(self.imageCRC is not None):
+            return self.imageCRC
+        self.CompletePage()
+        return zlib.crc32(self.contents)
+
+    def IsErased(self):
+        # True if everything the page should hold is erased flash
+        self.CompletePage()
+        return self.contents.count(ERASED_BYTE) == self.size
+
     def WritePage(self,force=False):
         if(force or self.dirty):
+            self.CompletePage()
             self.loader.WritePage(self.contents,self.lowAddress)
+            self.covered = None
+            self.loaded = True
             self.dirty=False
+            self.elided=False
 
     def GetSize(self):
         return self.size
@@ -73,21 +168,20 @@ class MemoryPage(object):
         if(address<self.lowAddress or address>self.highAddress):
             raise ValueError('Address out of range of object:'+
                              hex(self.lowAddress)+' '+hex(self.highAddress))
-        if(not self.loaded):
-            self.LoadPage()
         offset = address-self.lowAddress
+        self._PrepareWrite(offset,1)
         self.contents[offset] = data
+        self.imageCRC = None
         self.dirty=True
+        self.modified=True
         return
     
     def GetByte(self,address):
         if(address<self.lowAddress or address>self.highAddress):
             raise ValueError('Address out of range of object:'+
                              hex(self.lowAddress)+' '+hex(self.highAddress))
-        if(not self.loaded):
-            self.LoadPage()
-            
         offset = address-self.lowAddress
+        self._PrepareRead(offset,1)
         return self.contents[offset]
 
     def GetByteArray(self,address,length):
@@ -98,6 +192,29 @@ class MemoryPage(object):
             raise ValueError('Address out of range of object:'+str(self.lowAddress)+' '+str(self.highAddress))
         offset = address-self.lowAddress
         return self.contents[offset:offset+length-1]
+
+    def PutBlock(self,data,address):
+        # Copy a slice of data into this page in one go.  The caller has
+        # already split the data so that it does not cross a page boundary.
+        offset = address-self.lowAddress
+        if(offset<0 or offset+len(data)>self.size):
+            raise ValueError('Address out of range of object:'+
+                             hex(self.lowAddress)+' '+hex(self.highAddress))
+        self._PrepareWrite(offset,len(data))
+        self.contents[offset:offset+len(data)] = data
+        self.imageCRC = None
+        self.dirty=True
+        self.modified=True
+        return
+
+    def GetBlock(self,address,length):
+        offset = address-self.lowAddress
+        if(offset<0 or offset+length>self.size):
+            raise ValueError('Address out of range of object:'+
+                             hex(self.lowAddress)+' '+hex(self.highAddress))
+        self._PrepareRead(offset,length)
+        return self.contents[offset:offset+length]
+
     def GetRange(self):
         return ([self.lowAddress],[self.highAddress])
 
@@ -106,25 +223,90 @@ class Device(object):
     
     def __init__(self,low,high,loader):
         self.loader = loader
-        self.pageSize = MemoryPage.size
+        self.pageSize = loader.GetPageSize()
         self.lowAddress = low
         self.highAddress = high
         self.highIndex = int(high/self.pageSize)
         self.lowIndex = int(low/self.pageSize)
-        self.memory = [MemoryPage(i,loader) for i in
-                       range(low,high,self.pageSize)]
+        # Pages are only created when they are first touched.  The key is
+        # the page index, so sorting the keys gives address order.
+        self.memory = {}
+        self.deltaCache = None
+        self.journal = None
+        # Dirty pages that are all ERASED_BYTE are not written if the
+        # device page is already erased
+        self.skipErased = True
+        self.pagesWritten = 0
+        self.pagesSkipped = 0
+        self.pagesResumed = 0
+        self.pagesElided = 0
+        self.bytesElided = 0
         #print("Low="+str(low)+" High="+str(high))
     def _GetPageIndex(self,address):
-        return (int(address/self.pageSize))-self.lowIndex
+        return (address//self.pageSize)-self.lowIndex
+
+    def _GetPage(self,address):
+        if(address<self.lowAddress or address>self.highAddress):
+            raise ValueError('Address out of range of device:'+
+                             hex(self.lowAddress)+' '+hex(self.highAddress))
+        index = self._GetPageIndex(address)
+        page = self.memory.get(index)
+        if(page is None):
+            page = MemoryPage(address,self.loader)
+            self.memory[index] = page
+        return page
+
+    def _IterPages(self):
+        # Only the pages that have been touched, in address order
+        for index in sorted(self.memory):
+            yield self.memory[index]
     
     def GetByte(self,address):
-        return self.memory[self._GetPageIndex(address)].GetByte(address)
+        return self._GetPage(address).GetByte(address)
 
     def PutByte(self,data,address):
-        pageNum = int(address/self.pageSize)
-        offset = pageNum - self.lowIndex
-        self.memory[self._GetPageIndex(address)].PutByte(data,address)
+        self._GetPage(address).PutByte(data,address)
+        return
+    def PutBlock(self,data,address):
+        # Write a whole buffer starting at address.  It is split at page
+        # boundaries and each piece is copied into its page as a slice
+        # rather than byte by byte.
+        data = memoryview(data)
+        done = 0
+        while done < len(data):
+            thisAddr = address+done
+            page = self._GetPage(thisAddr)
+            length = min(len(data)-done, page.highAddress+1-thisAddr)
+            page.PutBlock(data[done:done+length],thisAddr)
+            done += length
         return
+
+    def LoadImage(self,image):
+        # Put a whole pyFirmwareImage.FirmwareImage into memory.  Each run
+        # of bytes the image has in a page goes in as one slice, so a full
+        # page is a single copy and a partial one keeps its coverage (and
+        # gets the rest from the device when it is written).  Full pages
+        # keep the CRC the image already has for them.
+        if(image.pageSize != self.pageSize):
+            raise ValueError('Image is in pages of '+hex(image.pageSize)+
+                             ' but the device has pages of '+hex(self.pageSize))
+        for pageAddress in image.PageAddresses():
+            for address,data in image.IterRuns(pageAddress):
+                self.PutBlock(data,address)
+            if(image.IsFull(pageAddress)):
+                self._GetPage(pageAddress).imageCRC = image.PageCRC(pageAddress)
+        return
+
+    def GetBlock(self,address,length):
+        # Read length bytes starting at address, crossing pages as needed
+        result = bytearray()
+        while len(result) < length:
+            thisAddr = address+len(result)
+            page = self._GetPage(thisAddr)
+            count = min(length-len(result), page.highAddress+1-thisAddr)
+            result += page.GetBlock(thisAddr,count)
+        return result
+
     def PutInt16(self,data,address):
         self.PutByte(data&0xff,address)
         self.PutByte((data>>8)&0xff,address+1)
@@ -139,19 +321,159 @@ class Device(object):
         highVal=self.GetInt16(address+2)
         return (highVal<<16)|lowVal
 
+    def SetDeltaCache(self,cache):
+        # With a pyDeltaCache.DeltaCache set, dirty pages whose contents
+        # hash the same as what was last written to this board are skipped.
+        # The cache is updated as pages are written, but not saved.
+        self.deltaCache = cache
+
+    def SetJournal(self,journal):
+        # With a pyFlashJournal.FlashJournal set, each page is noted in it as
+        # soon as it is on the device, and dirty pages it already has as
+        # written (by a flash that was interrupted) are skipped
+        self.journal = journal
+
+    def _PageDone(self,page):
+        # page is now on the device, whether we wrote it or not
+        if(self.deltaCache is not None):
+            self.deltaCache.Update(page.lowAddress,page.contents)
+        if(self.journal is not None):
+            self.journal.Add(page.lowAddress,page.contents)
+
+    def _WritePage(self,page):
+        page.WritePage(False) #Write, but only if it is dirty
+        self.pagesWritten += 1
+        self._PageDone(page)
+
+    def _FlushErased(self,run):
+        # run is adjacent dirty pages that should be erased.  Check the
+        # device with one CRC for the whole run if the loader can do it
+        # (and one per page if that does not match), otherwise with one
+        # read per page.  Pages that are already erased are not written.
+        if(not run):
+            return
+        if(self._CanCRC()):
+            length = run[-1].highAddress+1-run[0].lowAddress
+            erased = zlib.crc32(bytes([ERASED_BYTE])*length)
+            if(self.loader.ReadCRC(run[0].lowAddress,length) == erased):
+                toWrite = []
+            elif(len(run) == 1):
+                toWrite = run
+            else:
+                toWrite = [page for page in run
+                           if self.loader.ReadCRC(page.lowAddress,page.size) != page.CRC()]
+        else:
+            toWrite = [page for page in run
+                       if self.loader.ReadPage(page.lowAddress,page.size) != page.contents]
+        for page in run:
+            if(page in toWrite):
+                self._WritePage(page)
+                continue
+            page.dirty = False
+            page.elided = True
+            self.pagesElided += 1
+            self.bytesElided += page.size
+            self._PageDone(page)
+
     def MemoryFlush(self):
-        maxIndex = int((self.highAddress - self.lowAddress)/self.pageSize)
-        for i in range(0,maxIndex):
-            self.memory[i].WritePage(False) #Write, but only if it is dirty
+        self.pagesWritten = 0
+        self.pagesSkipped = 0
+        self.pagesResumed = 0
+        self.pagesElided = 0
+        self.bytesElided = 0
+        try:
+            erasedRun = []
+            for page in self._IterPages():
+                if(not page.dirty):
+                    continue
+                if(self.journal is not None and self.journal.resumePages):
+                    page.CompletePage()
+                    if(self.journal.Written(page.lowAddress,page.contents)):
+                        page.dirty = False
+                        self.pagesResumed += 1
+                        if(self.deltaCache is not None):
+                            self.deltaCache.Update(page.lowAddress,page.contents)
+                        continue
+                if(self.deltaCache is not None):
+                    page.CompletePage()
+                    if(self.deltaCache.Matches(page.lowAddress,page.contents)):
+                        page.dirty = False
+                        self.pagesSkipped += 1
+                        continue
+                if(self.skipErased and page.IsErased()):
+                    if(erasedRun and erasedRun[-1].highAddress+1 != page.lowAddress):
+                        self._FlushErased(erasedRun)
+                        erasedRun = []
+                    erasedRun.append(page)
+                    continue
+                self._WritePage(page)
+            self._FlushErased(erasedRun)
+        finally:
+            # The delta cache is not saved here: the caller saves it once
+            # MemoryCompare has checked the pages it now has
+            if(self.journal is not None):
+                self.journal.Close()
         return
     def MemoryLoad(self):
-        maxIndex = int((self.highAddress - self.lowAddress)/self.pageSize)
-        for i in range(0,maxIndex):
-            self.memory[i].LoadPage()
+        for page in self._IterPages():
+            page.LoadPage()
+    def _CanCRC(self):
+        supports = getattr(self.loader,'SupportsCRC',None)
+        return supports is not None and supports()
+
+    def _IterRuns(self):
+        # Group the pages holding host data into runs of adjacent pages
+        run = []
+        for page in self._IterPages():
+            if(not page.modified):
+                continue
+            if(run and run[-1].highAddress+1 != page.lowAddress):
+                yield run
+                run = []
+            run.append(page)
+        if(run):
+            yield run
+
     def MemoryCompare(self):
-        maxIndex = int((self.highAddress - self.lowAddress)/self.pageSize)
-        for i in range(0,maxIndex):
-            self.memory[i].TestPage()
+        # Check that the device holds what we wrote.  If the loader can
+        # give us a CRC of a range of flash, ask for one CRC per run of
+        # adjacent pages; for a run that does not match, ask for one per
+        # page and only read back the pages that do not match.  Full pages
+        # from the image use the CRC the image already has.
+        # Otherwise read back every page, except the erased ones that
+        # MemoryFlush has just read to see that they did not need writing.
+        # Mismatches are printed (and returned) as [first,last] address
+        # ranges.
+        useCRC = self._CanCRC()
+        failures = []
+        for run in self._IterRuns():
+            if(useCRC):
+                if(len(run) == 1):
+                    crc = run[0].CRC()
+                else:
+                    crc = 0
+                    for page in run:
+                        page.CompletePage()
+                        crc = zlib.crc32(page.contents,crc)
+                length = run[-1].highAddress+1-run[0].lowAddress
+                if(self.loader.ReadCRC(run[0].lowAddress,length) == crc):
+                    continue
+                if(len(run) > 1):
+                    # Only read back the pages whose own CRC is wrong
+                    run = [page for page in run
+                           if self.loader.ReadCRC(page.lowAddress,page.size) != page.CRC()]
+            for page in run:
+                if(page.elided and not useCRC):
+                    continue
+                for failure in page.TestPage():
+                    if(failures and failures[-1][1]+1 == failure[0]):
+                        failures[-1][1] = failure[1]
+                    else:
+                        failures.append(failure)
+        for first,last in failures:
+            print("\nCompare fail for addresses "+hex(first)+"-"+hex(last)+
+                  " ("+str(last-first+1)+" bytes)")
+        return failures
         
 
 if __name__ == '__main__':
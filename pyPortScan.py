@@ -0,0 +1,143 @@
+# /* Copyright (C) 2026 Burns Fisher
+#  * 
+#  * This program is free software; you can redistribute it and/or modify
+#  * it under the terms of the GNU General Public License as published by
+#  * the Free Software Foundation; either version 2 of the License, or
+#  * (at your option) any later version.
+#  *
+#  * This program is distributed in the hope that it will be useful,
+#  * but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  * GNU General Public License for more details.
+#  *
+#  * You should have received a copy of the GNU General Public License along
+#  * with this program; if not, write to the Free Software Foundation, Inc.,
+#  * 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#  * 
+#  */
+
+#
+# This module probes a list of serial ports for a flash loader all at the
+# same time, rather than one after another.  Each probe usually has to wait
+# out a readline timeout on ports that are not loaders, so on a host with
+# lots of USB serial adapters doing them in parallel saves a lot of time.
+#
+# It also remembers which port last answered as which kind of loader, so
+# the next run can try that port first.
+#
+
+import os
+import queue
+import threading
+import time
+import pyHostCache
+
+_cacheLock = threading.Lock()
+
+def _CachePath():
+    return os.path.join(pyHostCache.CacheDir('ports'),'ports.json')
+
+def GrepPorts(pattern):
+    "Names of the serial ports whose description matches the regex pattern"
+    # serial.tools.list_ports is slow to import, so only do it when we
+    # actually have to look for ports
+    import serial.tools.list_ports
+    return [pi.device for pi in serial.tools.list_ports.grep(pattern)]
+
+def LastPort(loaderType):
+    "What we remember about the port this type of loader was last found on"
+    try:
+        return pyHostCache.LoadJson(_CachePath(),{}).get(loaderType)
+    except OSError:
+        return None # No cache directory; we just scan everything
+
+def RememberPort(loaderType,port,**info):
+    # Record that port answered as loaderType, along with anything else
+    # worth remembering (flash range, board serial number).  Information
+    # from an earlier run on the same port is kept unless replaced.  This
+    # is only a hint for next time, so failing to save it is not an error.
+    with _cacheLock:
+        try:
+            cache = pyHostCache.LoadJson(_CachePath(),{})
+            entry = cache.get(loaderType) or {}
+            if entry.get('port') != port:
+                entry = {}
+            entry.update(info)
+            entry['port'] = port
+            cache[loaderType] = entry
+            pyHostCache.SaveJson(_CachePath(),cache)
+        except OSError:
+            pass
+
+def CachedScan(loaderType,ports,probe,quickProbe,deadline=10.0,findAll=False):
+    # Like ScanPorts, but when looking for just one loader first try the
+    # port it was on last time using quickProbe (which should use a short
+    # timeout).  Only if that misses do we probe everything.
+    if not findAll:
+        last = LastPort(loaderType)
+        if last is not None and last.get('port') in ports:
+            print("Trying "+last['port']+" first; the loader was there last time")
+            try:
+                loader = quickProbe(last['port'])
+            except Exception:
+                loader = None
+            if loader is not None:
+                return [loader]
+    found = ScanPorts(ports,probe,deadline,findAll)
+    if found and not findAll:
+        RememberPort(loaderType,found[0].GetDevice(),
+                     low=hex(found[0].GetLowAddr()),high=hex(found[0].GetHighAddr()))
+    return found
+
+def ScanPorts(ports,probe,deadline=10.0,findAll=False):
+    # Call probe(port) for every port, each on its own thread.  probe
+    # returns a connected loader object (something with a Close method)
+    # or raises an exception / returns None if there is no loader there.
+    #
+    # Returns a list of loaders found, in the order of ports.  Unless
+    # findAll is set we return as soon as the first one answers.  We never
+    # wait longer than deadline seconds; loaders that answer after we have
+    # returned are closed.
+    found = queue.Queue()
+    lock = threading.Lock()
+    state = {'done':False}
+
+    def ProbeOne(port):
+        try:
+            loader = probe(port)
+        except Exception:
+            loader = None
+        # Checking done and queueing the result under the same lock means
+        # a loader is either seen by the scan or closed here, never lost
+        with lock:
+            if state['done']:
+                if loader is not None:
+                    loader.Close()
+                return
+            found.put((port,loader))
+
+    for port in ports:
+        threading.Thread(target=ProbeOne,args=(port,),daemon=True).start()
+
+    results = {}
+    endTime = time.time()+deadline
+    for i in range(0,len(ports)):
+        remaining = endTime-time.time()
+        if remaining <= 0:
+            break
+        try:
+            port,loader = found.get(timeout=remaining)
+        except queue.Empty:
+            break
+        if loader is not None:
+            results[port] = loader
+            if not findAll:
+                break
+    with lock:
+        state['done'] = True
+    # Anything that arrived while we were stopping is not wanted either
+    while not found.empty():
+        port,loader = found.get()
+        if loader is not None and port not in results:
+            loader.Close()
+    return [results[port] for port in ports if port in results]
@@ -29,38 +29,57 @@ import platform
 import sys
 import traceback
 import serial
-import serial.tools.list_ports
+import struct
 import time
+import pyPortScan
+
+LOADER_TYPE = 'amsat'
+DEFAULT_BAUD = 57600
+# Rates to try, fastest first, when the loader says it can change baud rate
+FAST_BAUDS = [921600, 460800, 230400]
+
+def CandidatePorts():
+    "List the serial ports that an AMSAT serial loader might be on"
+    baseDevice = 'COM' if platform.system() == 'Windows' else '/dev/ttyUSB'
+    return pyPortScan.GrepPorts(baseDevice)
+
+def FindLoaders(debug=False, deadline=10.0, findAll=False):
+    "Probe all the candidate ports at once; return the first (or all) loaders"
+    return pyPortScan.CachedScan(LOADER_TYPE, CandidatePorts(),
+                                 lambda port: FlashLdr(device=port, debug=debug),
+                                 lambda port: FlashLdr(device=port, debug=debug, timeout=0.5),
+                                 deadline, findAll)
 
 class FlashLdr:
     "A representation of the AMSAT STM32 Serial Loader"
 
-    def __init__(self, device=None, debug=False):
+    def __init__(self, device=None, debug=False, timeout=2.0):
         self.dev = ""
+        self.probeTimeout = timeout
         self.IsSerialFlash = False
         self.gotDevice = False
+        self.features = set()
+        self.streamWrite = False
         self.output = bytearray([118])  # Bytearray with letter 'v'
 
         if device is None:
-            device = self._find_device()
+            device = self._find_device(debug)
         else:
             self._initialize_device(device)
 
         if not self.gotDevice:
-            raise ValueError(f'No loader responding in port {self.dev}')
+            raise ValueError(f'No loader responding in port {device}')
         else:
             self.dev = device
 
-    def _find_device(self):
+    def _find_device(self, debug):
         """Finds an appropriate serial device automatically."""
-        baseDevice = 'COM' if platform.system() == 'Windows' else '/dev/ttyUSB'
-        for pi in serial.tools.list_ports.grep(baseDevice):
-            devName = pi[0]
-            print(f"Checking {devName}")
-            if self._initialize_device(devName):
-                print(f"Loader found in {devName}")
-                return devName
-        return None
+        found = FindLoaders(debug=debug)
+        if not found:
+            return None
+        print(f"Loader found in {found[0].dev}")
+        self.__dict__.update(found[0].__dict__)
+        return self.dev
 
     def _initialize_device(self, device):
         """Attempts to open a device and check if it's the correct loader."""
@@ -72,7 +91,7 @@ class FlashLdr:
             if "/dev" in device and not "/dev" in devName:
                 devName = f"/dev/{devName}"
                 print(f"Devname after symlink conversion: {devName}")
-            self.port = serial.Serial(devName, timeout=2.0, baudrate=57600)
+            self.port = serial.Serial(devName, timeout=self.probeTimeout, baudrate=DEFAULT_BAUD)
             self.gotDevice = True
             self.port.flush()
             self.port.write(self.output)
@@ -96,6 +115,9 @@ class FlashLdr:
                     self.IsSerialFlash = True
                     #Yes!  It is a serial loader.  The other ifs get the other required info
                     print(f"\nPort {device} has a serial flash loader!\n")
+                if b'features' in stringFields[0]:
+                    # Newer loaders list what they can do before the version
+                    self.features = set(f.decode() for f in stringFields[1:])
                 if b'Version' in stringFields[0]:
                     print("Flash loader version " + stringFields[1].decode())
                     break
@@ -104,18 +126,34 @@ class FlashLdr:
             if not self.IsSerialFlash:
                 self.gotDevice = False
                 raise serial.SerialException
+            self.port.timeout = 2.0  # The probe may have used a shorter one
+            # Old loaders do not say "stream" and get the '.' handshake
+            self.streamWrite = 'stream' in self.features
+            if self.streamWrite:
+                print("Loader accepts streamed page writes")
             return True
 
         except serial.SerialException:
+            self._close_unused_port()
             return False
         except:
             traceback.print_exc()
+            self._close_unused_port()
             return False
 
+    def _close_unused_port(self):
+        """Not a loader (or it failed); leave the port for someone else."""
+        if hasattr(self, 'port'):
+            self.port.close()
+
 
     def GetDevice(self):
         "Get the OS name of the device that communicates with the loader"
         return self.dev
+
+    def Close(self):
+        "Let go of the serial port"
+        self.port.close()
     
     def GetLowAddr(self):
         "Get the low address that the loader has told us its embedded device has"
@@ -129,25 +167,65 @@ class FlashLdr:
         "Get the page size of this device"
         return 0x100 # If we could get it from the loader, we should
     
+    def SupportsCRC(self):
+        "True if the loader can return a CRC of a range of flash"
+        return 'crc' in self.features
+
+    def NegotiateBaud(self, baud=None):
+        """Move both ends to a faster baud rate if the loader can do it.
+        With baud given only that rate is tried, otherwise FAST_BAUDS in
+        order.  Returns the rate in use afterwards."""
+        if 'baud' not in self.features:
+            return self.port.baudrate
+        for rate in ([baud] if baud else FAST_BAUDS):
+            if rate == self.port.baudrate:
+                break
+            if self._SwitchBaud(rate):
+                print(f"Switched to {rate} baud")
+                break
+        return self.port.baudrate
+
+    def _SwitchBaud(self, rate):
+        # 'B <rate>' is answered '+' or '-' at the old rate.  After a '+'
+        # the loader changes rate and waits (about a second) for a 'p' at
+        # the new rate, which it answers with 'P'.  If the probe does not
+        # get through it goes back to the old rate.  Either way it then
+        # prompts with 'o' as usual.
+        oldRate = self.port.baudrate
+        self.__WaitAndSendCommand(f'B {rate}\n')
+        if self.port.read(size=1) != b'+':
+            return False
+        self.port.baudrate = rate
+        time.sleep(0.05)  # Give the loader time to change over
+        self.port.flushInput()
+        self.port.write(b'p')
+        if self.port.read(size=1) == b'P':
+            return True
+        # The loader will be back at the old rate (and prompt) shortly
+        self.port.baudrate = oldRate
+        print(f"{rate} baud did not work")
+        return False
+
+    def ReadCRC(self,address,size):
+        "Ask the loader for the CRC-32 (as zlib computes it) of a range of flash"
+        sys.stdout.flush()
+        self.port.flush()
+        command = 'C '+hex(address)[2:]+' '+hex(size)[2:]+'\n'
+        self.__WaitAndSendCommand(command)
+        return int.from_bytes(self.port.read(4),'little')
+
     def ReadPage(self,address,size):
 	#print("Reading page "+hex(address)+" of size "+hex(size))
         sys.stdout.flush()
-        self.port.flushOutput()
+        self.port.flush()
         command = 'R '+ hex(address)[2:]+'\n' #Don't want the 0x in front
         #print(command)
         #self.port.write(command)
         self.__WaitAndSendCommand(command)
         contents = bytearray(size)   
         self.port.readinto(contents) #Read one page of bytes
-        readChecksum = 0
-        for i in range(0,4):
-            value = ord(self.port.read(1))
-            readChecksum = readChecksum | (value << (i*8))
-        calcChecksum = 0
-        for i in range(0,64):
-            for j in range(0,4):
-                byte = contents[j+(i*4)]
-                calcChecksum = (calcChecksum + (byte<<(j*8))) & 0xffffffff
+        readChecksum = int.from_bytes(self.port.read(4),'little')
+        calcChecksum = self._Checksum(contents)
         #print("CalcCheck:"+hex(calcChecksum)+" Read:"+hex(readChecksum))
         if(calcChecksum == readChecksum):
             sys.stdout.write('-')
@@ -157,29 +235,53 @@ class FlashLdr:
         return contents
 
     def WritePage(self,outBuf,address):
+        if self.streamWrite:
+            self._StreamWritePage(outBuf,address)
+            return
         sys.stdout.flush()
-        self.port.flushOutput()
+        self.port.flush()
         command = 'W '+ hex(address)[2:]+'\n' #Don't want the 0x in front
         self.__WaitAndSendCommand(command)
-        bytes = bytearray(4)
-        calcChecksum = 0
-        for i in range(0,64):
-            for j in range(0,4):
-                #Speed it up a bit by sending 4 bytes at a time
-                byte = outBuf[j+(i*4)]
-                bytes[j] = byte
-                calcChecksum = calcChecksum + (byte<<(j*8))
-            self.__WaitAndSendByte(bytes)
-
-        for i in range (0,4):
-            bytes[i] = (calcChecksum>>(i*8))&0xff
-        self.__WaitAndSendByte(bytes)
-        self.port.flushOutput()
+        outBuf = bytes(outBuf)
+        for i in range(0,len(outBuf),4):
+            #Speed it up a bit by sending 4 bytes at a time
+            self.__WaitAndSendByte(outBuf[i:i+4])
+        self.__WaitAndSendByte(self._Checksum(outBuf).to_bytes(4,'little'))
+        self.port.flush()
         sys.stdout.write('.')
         return
+    def _StreamWritePage(self,outBuf,address,retries=3):
+        # The whole page and its checksum go out in one write after an
+        # 'S' command; the loader answers '+' if the checksum matched or
+        # '-' if it did not, in which case we send the page again.
+        checksum = self._Checksum(outBuf)
+        packet = ('S '+hex(address)[2:]+'\n').encode()+bytes(outBuf)+ \
+                 checksum.to_bytes(4,'little')
+        for attempt in range(0,retries):
+            sys.stdout.flush()
+            self.port.flush()
+            self.__WaitAndSendCommand(packet)
+            reply = self.port.read(size=1)
+            if reply == b'+':
+                sys.stdout.write('.')
+                return
+            sys.stdout.write('X')
+        raise ValueError('Loader did not accept page at '+hex(address))
+
+    @staticmethod
+    def _Checksum(buf):
+        # The loader's checksum is the 32-bit sum of the page taken as
+        # little-endian words.  Unpack the whole buffer at once rather
+        # than shifting byte by byte; any page size works, and a ragged
+        # end is padded with zeros.
+        buf = bytes(buf)
+        if len(buf) % 4:
+            buf += bytes(4 - len(buf) % 4)
+        return sum(struct.unpack('<%dI' % (len(buf)//4), buf)) & 0xffffffff
+
     def StartExecution(self):
         #self.port.flushInput()
-        self.port.flushOutput()
+        self.port.flush()
         self.port.write(b'a')
         return
     def __WaitAndSendCommand(self,command):
@@ -188,7 +290,9 @@ class FlashLdr:
         while(retval.decode() != 'o'):
             retval = self.port.read(size=1) #Wait for \n
         self.port.flushInput()
-        self.port.write(command.encode())
+        if isinstance(command,str):
+            command = command.encode()
+        self.port.write(command)
 	#print(command)
         return
     def __WaitAndSendByte(self,byte):
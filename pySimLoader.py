@@ -0,0 +1,411 @@
+# /* Copyright (C) 2026 Burns Fisher
+#  *
+#  * This program is free software; you can redistribute it and/or modify
+#  * it under the terms of the GNU General Public License as published by
+#  * the Free Software Foundation; either version 2 of the License, or
+#  * (at your option) any later version.
+#  *
+#  * This program is distributed in the hope that it will be useful,
+#  * but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  * GNU General Public License for more details.
+#  *
+#  * You should have received a copy of the GNU General Public License along
+#  * with this program; if not, write to the Free Software Foundation, Inc.,
+#  * 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#  *
+#  */
+
+#
+# Simulated flash loaders, so that pyAltosFlash, pySerialFlash and
+# pyTISerialFlash can be run (and timed) without any hardware.  Each class
+# here pretends to be an MCU running one of the flash loaders, with its
+# flash memory kept in a bytearray.  It talks to the host over a pseudo
+# terminal, so the real FlashLdr classes just open the device name that
+# Start() returns and do not know the difference.
+#
+# Each simulator can also pretend to be slow: it sleeps for the time the
+# bytes would take on the wire at the given baud rate (10 bits per byte),
+# plus a fixed latency every time it answers the host.  The AMSAT and TI
+# simulators will also agree to a faster baud rate, up to maxBaud, when the
+# host asks for one.
+#
+# Pseudo terminals are a Unix thing, so this does not work on Windows.
+#
+# Run it by itself to get a simulated loader to point pyMicroloader at:
+#   python pySimLoader.py amsat|altos|ti
+#
+
+import os
+import select
+import struct
+import sys
+import threading
+import time
+import tty
+import zlib
+
+class _Stopped(Exception):
+    'The simulator was stopped while it was in the middle of something'
+
+
+class SimulatedLoader(object):
+    'Common part of the simulated MCUs: the pty, the timing and the flash'
+
+    pageSize = 0x100
+
+    def __init__(self,low=0x8000000,high=0x8100000,baud=57600,latency=0.0,
+                 maxBaud=921600):
+        # low and high are the flash range; high is one past the end just
+        # like the loaders report it
+        self.low = low
+        self.high = high
+        self.baud = baud
+        self.latency = latency
+        self.maxBaud = maxBaud
+        self.flash = bytearray(b'\xff'*(high-low))
+        self.started = False
+        self.running = False
+        self.buffer = bytearray()
+        self.ResetCounters()
+
+    def ResetCounters(self):
+        self.bytesIn = 0
+        self.bytesOut = 0
+        self.commands = 0
+        self.roundTrips = 0
+        self.waitingForHost = True
+
+    def Start(self):
+        "Start the simulated MCU; returns the device name for the host to open"
+        self.master,self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.device = os.ttyname(self.slave)
+        self.running = True
+        self.thread = threading.Thread(target=self._Run,daemon=True)
+        self.thread.start()
+        return self.device
+
+    def Stop(self):
+        self.running = False
+        self.thread.join(2)
+        os.close(self.master)
+        os.close(self.slave)
+
+    def GetDevice(self):
+        return self.device
+
+    def _Run(self):
+        try:
+            while self.running:
+                command = self._Read(1)
+                self.commands += 1
+                self.Handle(command)
+        except _Stopped:
+            pass # Stop() was called, perhaps in the middle of a command
+        except OSError:
+            pass # The host went away
+
+    def Handle(self,command):
+        pass
+
+    def _WireTime(self,count):
+        if self.baud:
+            time.sleep(count*10.0/self.baud)
+
+    def _Read(self,count,timeout=None):
+        # Read exactly count bytes from the host.  Returns None if nothing
+        # arrives within timeout seconds, and raises _Stopped if we are
+        # stopped, so Handle never has to check for that.
+        endTime = None if timeout is None else time.time()+timeout
+        while len(self.buffer) < count:
+            if not self.running:
+                raise _Stopped
+            wait = 0.1
+            if endTime is not None:
+                wait = min(wait,endTime-time.time())
+                if wait <= 0:
+                    return None
+            ready,_,_ = select.select([self.master],[],[],wait)
+            if ready:
+                self.buffer += os.read(self.master,4096)
+        data = bytes(self.buffer[:count])
+        del self.buffer[:count]
+        self.bytesIn += count
+        self._WireTime(count)
+        self.waitingForHost = False
+        return data
+
+    def _ReadLine(self):
+        line = bytearray()
+        while True:
+            byte = self._Read(1)
+            if byte == b'\n':
+                return line.decode()
+            line += byte
+
+    def _Send(self,data):
+        if isinstance(data,str):
+            data = data.encode()
+        if not self.waitingForHost:
+            # First thing we have said since the host last spoke
+            self.roundTrips += 1
+            self.waitingForHost = True
+            if self.latency:
+                time.sleep(self.latency)
+        self._WireTime(len(data))
+        os.write(self.master,data)
+        self.bytesOut += len(data)
+
+    def _ChangeBaud(self,line):
+        # The host asked for the rate in line.  Say '+' or '-' at the old
+        # rate, then wait a second for its 'p' at the new one.  Returns
+        # True if the host got through and we are now at the new rate.
+        rate = int(line)
+        if rate > self.maxBaud:
+            self._Send('-')
+            return False
+        self._Send('+')
+        oldBaud = self.baud
+        if self.baud:
+            self.baud = rate
+        if self._Read(1,timeout=1) == b'p':
+            self._Send('P')
+            return True
+        self.baud = oldBaud
+        return False
+
+    def _Page(self,address,size=None):
+        offset = address-self.low
+        return self.flash[offset:offset+(size or self.pageSize)]
+
+    def _Store(self,address,data):
+        offset = address-self.low
+        if offset < 0 or offset+len(data) > len(self.flash):
+            return
+        self.flash[offset:offset+len(data)] = data
+
+
+class AltosSim(SimulatedLoader):
+    'Pretends to be an MCU running the Altus Metrum AltosFlash loader'
+
+    def __init__(self,**kwargs):
+        # The Altos loader is on USB, so there is no baud rate to emulate;
+        # only the latency applies
+        SimulatedLoader.__init__(self,**kwargs)
+        self.baud = 0
+
+    def Handle(self,command):
+        if command == b'v':
+            self._Send("manufacturer     altusmetrum.org\n"
+                       "product          AltosFlash-sim\n"
+                       "flash-range      %08x %08x\n"
+                       "software-version 1.0\n" % (self.low,self.high))
+        elif command == b'R':
+            address = int(self._ReadLine(),16)
+            self._Send(bytes(self._Page(address)))
+        elif command == b'W':
+            address = int(self._ReadLine(),16)
+            self._Store(address,self._Read(self.pageSize))
+        elif command == b'a':
+            self.started = True
+
+
+class AmsatSim(SimulatedLoader):
+    'Pretends to be an MCU running the AMSAT Golf serial loader'
+
+    def __init__(self,features=('stream','crc','baud'),**kwargs):
+        # features is what the loader claims in its banner.  An empty
+        # list gives an old loader with no features line at all.
+        SimulatedLoader.__init__(self,**kwargs)
+        self.features = list(features)
+        self.badChecksums = 0
+
+    @staticmethod
+    def _Checksum(data):
+        return sum(struct.unpack('<%dI' % (len(data)//4),data)) & 0xffffffff
+
+    def Handle(self,command):
+        if command == b'v':
+            banner = "AMSAT GolfSerialLoader\nflash-range %08x %08x\n" % (self.low,self.high)
+            if self.features:
+                banner += "features "+" ".join(self.features)+"\n"
+            self._Send(banner+"Version 3.0\n")
+        elif command == b'R':
+            address = int(self._ReadLine(),16)
+            page = bytes(self._Page(address))
+            self._Send(page+self._Checksum(page).to_bytes(4,'little'))
+        elif command == b'W':
+            # The old way: a '.' prompt before every 4 bytes
+            address = int(self._ReadLine(),16)
+            page = bytearray()
+            for i in range(0,self.pageSize//4+1):
+                self._Send('.')
+                page += self._Read(4)
+            if self._Checksum(page[:-4]) == int.from_bytes(page[-4:],'little'):
+                self._Store(address,page[:-4])
+            else:
+                self.badChecksums += 1
+        elif command == b'S' and 'stream' in self.features:
+            address = int(self._ReadLine(),16)
+            page = self._Read(self.pageSize+4)
+            if self._Checksum(page[:-4]) == int.from_bytes(page[-4:],'little'):
+                self._Store(address,page[:-4])
+                self._Send('+')
+            else:
+                self.badChecksums += 1
+                self._Send('-')
+        elif command == b'C' and 'crc' in self.features:
+            fields = self._ReadLine().split()
+            crc = zlib.crc32(self._Page(int(fields[0],16),int(fields[1],16)))
+            self._Send(crc.to_bytes(4,'little'))
+        elif command == b'B' and 'baud' in self.features:
+            self._ChangeBaud(self._ReadLine())
+        elif command == b'a':
+            self.started = True
+            return
+        else:
+            return
+        self._Send('o') # Ready for the next command
+
+
+class TISim(SimulatedLoader):
+    'Pretends to be a TI TMS570 running the YMODEM flash loader'
+
+    SOH = b'\x01'
+    STX = b'\x02'
+    EOT = b'\x04'
+    ACK = b'\x06'
+    NAK = b'\x15'
+    CAN = b'\x18'
+    CRC = b'C'
+    STREAM = b'G'
+
+    def __init__(self,low=0x20000,high=0x400000,baud=115200,features=('baud',),
+                 **kwargs):
+        SimulatedLoader.__init__(self,low=low,high=high,baud=baud,**kwargs)
+        self.features = list(features)
+        self.received = None
+
+    @staticmethod
+    def _Crc16(data):
+        crc = 0
+        for byte in data:
+            crc ^= byte << 8
+            for i in range(0,8):
+                crc = ((crc << 1) ^ 0x1021) if crc & 0x8000 else crc << 1
+            crc &= 0xffff
+        return crc
+
+    def Handle(self,command):
+        if command == b'4':
+            self._Send("\r\nFlash Loader TI: 1.0.0\r\n")
+        elif command == b'5':
+            info = "FLASH START: %08X\r\nFLASH END: %08X\r\n" % (self.low,self.high)
+            if self.features:
+                info = "FEATURES: "+" ".join(self.features)+"\r\n"+info
+            self._Send(info)
+        elif command == b'6' and 'baud' in self.features:
+            self._ChangeBaud(self._ReadLine())
+        elif command == b'1':
+            self._ReceiveYmodem()
+        elif command == b'7' and 'ymodem-g' in self.features:
+            self._ReceiveYmodem(streaming=True)
+        elif command == b'3':
+            self.started = True
+
+    def _ReadPacket(self,start):
+        # Returns (sequence, data) or None if the packet was damaged
+        size = 128 if start == self.SOH else 1024
+        rest = self._Read(2+size+2,timeout=5)
+        if rest is None:
+            return None
+        if rest[0] != 0xff-rest[1]:
+            return None
+        data = rest[2:2+size]
+        if self._Crc16(data) != int.from_bytes(rest[2+size:],'big'):
+            return None
+        return rest[0],data
+
+    def _NextStart(self,prompt,tries=10):
+        # Send the prompt until the host starts a packet (or gives up)
+        for i in range(0,tries):
+            if prompt is not None:
+                self._Send(prompt)
+            start = self._Read(1,timeout=1)
+            if start is not None:
+                return start
+        return None
+
+    def _Purge(self):
+        # Throw away input until the line goes quiet
+        while self._Read(1,timeout=0.5) is not None:
+            if self.buffer:
+                self._Read(len(self.buffer))
+
+    def _ReceiveYmodem(self,streaming=False):
+        # Receive one file, then the empty header that ends the batch.
+        # Whatever is received is written to flash starting at low.  When
+        # streaming (YMODEM-G) only the EOT is ACKed: the header is answered
+        # with another 'G', the data packets and the empty header not at
+        # all, and a bad packet cancels the whole transfer.
+        prompt = self.STREAM if streaming else self.CRC
+        start = self._NextStart(prompt)
+        if start not in (self.SOH,self.STX):
+            return
+        packet = self._ReadPacket(start)
+        if packet is None or packet[0] != 0:
+            self._Send(self.CAN+self.CAN)
+            return
+        name,size = packet[1].split(b'\x00')[0:2]
+        size = int(size.split(b' ')[0] or b'0')
+        if not streaming:
+            self._Send(self.ACK)
+        data = bytearray()
+        sequence = 1
+        start = self._NextStart(prompt)
+        while start in (self.SOH,self.STX):
+            packet = self._ReadPacket(start)
+            if streaming and (packet is None or packet[0] != sequence & 0xff):
+                self._Send(self.CAN+self.CAN)
+                self._Purge()
+                return
+            if streaming:
+                data += packet[1]
+                sequence += 1
+            elif packet is not None and packet[0] == sequence & 0xff:
+                data += packet[1]
+                sequence += 1
+                self._Send(self.ACK)
+            elif packet is not None and packet[0] == (sequence-1) & 0xff:
+                self._Send(self.ACK) # A repeat of one we already have
+            else:
+                self._Send(self.NAK)
+            start = self._Read(1,timeout=5)
+        if start != self.EOT:
+            return
+        self._Send(self.ACK)
+        self.received = (name.decode(),bytes(data[:size]))
+        self._Store(self.low,data[:size])
+        # End of batch: an empty header packet
+        start = self._NextStart(prompt)
+        if start in (self.SOH,self.STX):
+            self._ReadPacket(start)
+            if not streaming:
+                self._Send(self.ACK)
+
+
+SIMULATORS = {'altos':AltosSim,'amsat':AmsatSim,'ti':TISim}
+
+if __name__ == '__main__':
+    kind = sys.argv[1] if len(sys.argv) > 1 else 'amsat'
+    sim = SIMULATORS[kind]()
+    print("Simulated "+kind+" loader on "+sim.Start())
+    print("Use it with: python pyMicroloader.py file.elf --port "+sim.GetDevice())
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print("Commands="+str(sim.commands)+" round trips="+str(sim.roundTrips)+
+              " bytes in="+str(sim.bytesIn)+" bytes out="+str(sim.bytesOut))
+        sim.Stop()
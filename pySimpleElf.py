@@ -1,99 +1,132 @@
+import mmap
 import os
 import sys
-import threading
-import traceback
-import time
 
-from elftools import __version__
 from elftools.common.exceptions import ELFError
-from elftools.common.py3compat import (
-        ifilter, byte2int, bytes2str, itervalues, str2bytes)
 from elftools.elf.elffile import ELFFile
-from elftools.elf.dynamic import DynamicSection, DynamicSegment
-from elftools.elf.enums import ENUM_D_TAG
-from elftools.elf.segments import InterpSegment, NoteSegment
 from elftools.elf.sections import SymbolTableSection
-from elftools.elf.gnuversions import (
-    GNUVerSymSection, GNUVerDefSection,
-    GNUVerNeedSection,
-    )
-from elftools.elf.relocation import RelocationSection
-from elftools.elf.descriptions import (
-    describe_ei_class, describe_ei_data, describe_ei_version,
-    describe_ei_osabi, describe_e_type, describe_e_machine,
-    describe_e_version_numeric, describe_p_type, describe_p_flags,
-    describe_sh_type, describe_sh_flags,
-    describe_symbol_type, describe_symbol_bind, describe_symbol_visibility,
-    describe_symbol_shndx, describe_reloc_type, describe_dyn_tag,
-    describe_ver_flags, describe_note
-    )
-from elftools.elf.constants import E_FLAGS
-from elftools.dwarf.dwarfinfo import DWARFInfo
-from elftools.dwarf.descriptions import (
-    describe_reg_name, describe_attr_value, set_global_machine_arch,
-    describe_CFI_instructions, describe_CFI_register_rule,
-    describe_CFI_CFA_rule,
-    )
-from elftools.dwarf.constants import (
-    DW_LNS_copy, DW_LNS_set_file, DW_LNE_define_file)
-from elftools.dwarf.callframe import CIE, FDE
+from pyImageFile import ImageFile
 
-class SimpleElf:
+class SimpleElf(ImageFile):
     def __init__(self,file):
+        # file is either the name of the ELF file or a file opened in
+        # binary mode.  The file is mapped into memory if it can be, so
+        # pyelftools reads the headers straight from the mapping and the
+        # code returned by IterCode is just a view on it.
         self.currentCodeSegment=0
         self.isOk=False
-        self.startSeg=0
-        self.startSec=0
-        elffile = ELFFile(file)
+        self.nextCode=0
+        self.symbols=None # name -> (value,size,section index), built on first use
+        self.map=None
+        if(isinstance(file,(str,bytes,os.PathLike))):
+            with open(file,'rb') as realFile:
+                self.map = mmap.mmap(realFile.fileno(),0,access=mmap.ACCESS_READ)
+        else:
+            try:
+                self.map = mmap.mmap(file.fileno(),0,access=mmap.ACCESS_READ)
+            except (AttributeError,OSError,ValueError):
+                pass # Not a real file (or an empty one); read it instead
+        if(self.map is not None):
+            stream = self.map
+            self.image = memoryview(self.map)
+        else:
+            stream = file
+            file.seek(0)
+            self.image = memoryview(file.read())
+        elffile = ELFFile(stream)
         if(elffile.elfclass != 32):
+            self.Close()
             raise Exception("64 bit Elf File","Can't deal right now")
         else:
             self.myElffile = elffile
             self.isOk=True
+        self.loadMap = self._MakeLoadMap()
         return
+    def Close(self):
+        # Done with the file.  If code from IterCode is still in use the
+        # mapping stays until that is gone too.
+        self.isOk=False
+        self.image.release()
+        if(self.map is not None):
+            try:
+                self.map.close()
+            except BufferError:
+                pass
+            self.map=None
     def _CheckOk(self):
         if(not self.isOk):
             raise Exception("Elf file not open")
-    def GetSymbol(self,symbol):
-        self._CheckOk()
-        for section in self.myElffile.iter_sections():
-            if  not isinstance(section,SymbolTableSection):
+    def _MakeLoadMap(self):
+        # Work out once where each loadable section goes.  A section is
+        # loaded if it has contents in the file that fall within a PT_LOAD
+        # segment; its physical address is the segment's plus its offset
+        # into the segment.  (Other segments, like PT_NOTE, only repeat
+        # what is already in a PT_LOAD one.)  The result is a list of
+        # [paddr,offset,size].
+        loadMap = []
+        for segment in self.myElffile.iter_segments():
+            if(segment['p_type'] != 'PT_LOAD'):
                 continue
-            if(section['sh_entsize']==0):
-               continue
-            for nsym, symbolStruct in enumerate(section.iter_symbols()):
-                if symbolStruct.name == symbol:
-                    return symbolStruct['st_value']
-    def GetCode(self):
-        for segNum in range(self.startSeg,self.myElffile.num_segments()):
-            self.startSeg = segNum #Be able to restart
-            segment=self.myElffile.get_segment(segNum)
-            #for segment in myElffile.iter_segments():
-            #print("Got segment number "+str(segNum))
             psecPaddr=segment['p_paddr']
-            psecVaddr=segment['p_vaddr']
             psecOffset=segment['p_offset']
             psecFilesz=segment['p_filesz']
-            psecMemsz=segment['p_memsz']
-            #print('phdr: Paddr='+hex(psecPaddr)+' Vaddr='+hex(psecVaddr))
-            #for nsec, section in enumerate(myElffile.iter_sections()):
-            for secNum in range(self.startSec,self.myElffile.num_sections()):
-                self.startSec=secNum+1
-                section = self.myElffile.get_section(secNum)
+            for section in self.myElffile.iter_sections():
                 sOffset = section['sh_offset']
-                sPaddr = psecPaddr + sOffset - psecOffset
                 sSize = section['sh_size']
-                #print("sSize="+hex(sSize)+" psecOffset="+hex(psecOffset)+" sOffset="+hex(sOffset)+
-                 #     " sum="+hex(psecOffset+psecFilesz))
+                if(section['sh_type'] == 'SHT_NOBITS'):
+                    continue # Like .bss, nothing in the file to load
                 if(sSize!=0 and psecOffset<=sOffset and sOffset<(psecOffset+psecFilesz)):
-                    #print('Returning Section paddr='+hex(sPaddr)+' Size='+hex(sSize))
-                    data = section.data()
-                    return[data,sPaddr,sSize]
-                #else:
-                    #print("Skiping section "+str(secNum))
-                    
-            self.startSec=0
-            
+                    loadMap.append([psecPaddr+sOffset-psecOffset,sOffset,sSize])
+        return loadMap
+    def _IndexSymbols(self):
+        # Read every symbol table once.  If a name appears more than once
+        # the first one wins, as it did when we searched for each symbol.
+        self.symbols = {}
+        for section in self.myElffile.iter_sections():
+            if  not isinstance(section,SymbolTableSection):
+                continue
+            if(section['sh_entsize']==0):
+               continue
+            for symbolStruct in section.iter_symbols():
+                if symbolStruct.name not in self.symbols:
+                    self.symbols[symbolStruct.name] = (symbolStruct['st_value'],
+                                                       symbolStruct['st_size'],
+                                                       symbolStruct['st_shndx'])
+    def GetSymbolInfo(self,symbol):
+        "Returns (value,size,section index) for symbol, or None"
+        self._CheckOk()
+        if(self.symbols is None):
+            self._IndexSymbols()
+        return self.symbols.get(symbol)
+    def GetSymbol(self,symbol):
+        info = self.GetSymbolInfo(symbol)
+        if(info is not None):
+            return info[0]
+    def IterCode(self):
+        # Yield (address,data) for everything to be loaded, in file order.
+        # data is a memoryview on the file contents, so nothing is copied.
+        # Sections that follow on from each other both in memory and in
+        # the file come out as one piece.
+        address = None
+        for paddr,offset,size in self.loadMap:
+            if(address is not None and paddr == address+length and
+               offset == start+length):
+                length += size
+                continue
+            if(address is not None):
+                yield address,self.image[start:start+length]
+            address,start,length = paddr,offset,size
+        if(address is not None):
+            yield address,self.image[start:start+length]
+    def GetCode(self):
+        # Returns [data,address,size] for the next loadable section, or None
+        # when there are no more
+        if(self.nextCode >= len(self.loadMap)):
+            return None
+        paddr,offset,size = self.loadMap[self.nextCode]
+        self.nextCode += 1
+        return [bytes(self.image[offset:offset+size]),paddr,size]
+
 if __name__ == '__main__':
     with open('test.elf','rb') as file:
         try:
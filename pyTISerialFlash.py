@@ -10,12 +10,34 @@
 
 import platform
 import sys
-from tkinter import Y
 import traceback
 import serial
-import serial.tools.list_ports
 import re
+import time
 from pyYmodem import YmodemMCU
+import pyPortScan
+
+LOADER_TYPE = 'ti'
+DEFAULT_BAUD = 115200
+# Rates to try, fastest first, when the loader says it can change baud rate
+FAST_BAUDS = [921600, 460800, 230400]
+
+
+def CandidatePorts():
+    "List the serial ports that a TI flash loader might be on"
+    if platform.system() == 'Windows':
+        baseDevice = 'COM'
+    else:
+        baseDevice = '/dev/ttyUSB'
+    return pyPortScan.GrepPorts(baseDevice)
+
+
+def FindLoaders(debug=False, deadline=10.0, findAll=False):
+    "Probe all the candidate ports at once; return the first (or all) loaders"
+    return pyPortScan.CachedScan(LOADER_TYPE, CandidatePorts(),
+                                 lambda port: FlashLdr(device=port, debug=debug),
+                                 lambda port: FlashLdr(device=port, debug=debug, timeout=0.3),
+                                 deadline, findAll)
 
 
 class FlashLdr:
@@ -24,7 +46,7 @@ class FlashLdr:
     # All host loader classes have the same public methods
     #
 
-    def __init__(self, device=None, debug=False):
+    def __init__(self, device=None, debug=False, timeout=1):
         self.dev = ""
         self.found_flash_loader = False
         self.flash_loader_version = None
@@ -33,20 +55,29 @@ class FlashLdr:
         self.low_address_as_int = None
         self.high_address_as_int = None
         self.download_application_command = [ord('1')]
+        self.download_streaming_command = [ord('7')]
         self.execute_application_command = [ord('3')]
         self.flash_loader_version_command = [ord('4')]
         self.device_version_command = [ord('5')]
+        self.change_baud_command = [ord('6')]
+        self.features = set()
+        self.transfer_counters = None  # From the last ymodem transfer
         self.gotDevice = False
         if(device == None):
-            if platform.system() == 'Windows':
-                baseDevice = 'COM'
-            else:
-                baseDevice = '/dev/ttyUSB'
+            # Try all the possible ports at the same time; each one that
+            # is not a loader costs us a readline timeout.
+            found = FindLoaders(debug)
+            if not found:
+                raise ValueError(
+                    f"No loader responding in {' '.join(CandidatePorts())} ports")
+            self.__dict__.update(found[0].__dict__)
+            return
         else:
-            baseDevice = device
+            # Match only this port (so ttyUSB1 does not also find ttyUSB10).
+            # If it is not listed (a pty, for example) just try to open it.
+            portNames = pyPortScan.GrepPorts(re.escape(device) + '$') or [device]
 
-        portInfos = serial.tools.list_ports.grep(baseDevice)
-        for pi in portInfos:
+        for devName in portNames:
             # This for is iterating over the available serial devices
             try:
                 # Ok, we'll try to open the device names that we found
@@ -55,9 +86,8 @@ class FlashLdr:
                 # look like a flash loader, SerialException is raised
                 # and we try again
 
-                devName = pi.device
                 print(f"Trying {devName}")
-                self.port = serial.Serial(devName, timeout=1, baudrate=115200)
+                self.port = serial.Serial(devName, timeout=timeout, baudrate=DEFAULT_BAUD)
                 self.gotDevice = True
 
                 while True:
@@ -77,9 +107,12 @@ class FlashLdr:
             except:
                 traceback.print_exc()
             if(self.found_flash_loader):
+                self.port.timeout = 1
                 break
+            if hasattr(self, 'port'):
+                self.port.close()  # Not a loader; leave it for someone else
         if(not self.gotDevice):
-            raise ValueError(f"No loader responding in {baseDevice} ports")
+            raise ValueError(f"No loader responding in {device} ports")
         else:
             self.dev = devName
 
@@ -109,7 +142,8 @@ class FlashLdr:
     def _get_device_information(self, debug):
         """
         Issue the device version command and pluck the values
-        of 'FLASH START:' and 'FLASH END:' from the response
+        of 'FLASH START:' and 'FLASH END:' from the response, plus
+        'FEATURES:' from newer loaders (which send it first)
         """
         self.port.reset_input_buffer()
         self.port.write(self.device_version_command)
@@ -121,6 +155,8 @@ class FlashLdr:
                     print(f"Flash 0x{self.flash_start} - 0x{self.flash_end}")
                 return
             dev_info_string = (response.decode("utf-8")).strip()
+            if re.match('^FEATURES:', dev_info_string):
+                self.features = set(dev_info_string.lower().split()[1:])
             if re.match('^FLASH START:', dev_info_string):
                 m = re.search('([0-9A-F]+$)', dev_info_string)
                 self.flash_start = m.group(1)
@@ -132,6 +168,10 @@ class FlashLdr:
         "Get the OS name of the device that communicates with the loader"
         return self.dev
 
+    def Close(self):
+        "Let go of the serial port"
+        self.port.close()
+
     def GetLowAddr(self):
         "Get the low address that the loader has told us its embedded device has"
         return self.low_address_as_int
@@ -144,6 +184,52 @@ class FlashLdr:
         "Get the page size of this device"
         return 0x100  # If we could get it from the loader, we should
 
+    def SupportsCRC(self):
+        "True if the loader can return a CRC of a range of flash"
+        return False
+
+    def NegotiateBaud(self, baud=None):
+        """
+        Move both ends to a faster baud rate if the loader can do it.
+        With baud given only that rate is tried, otherwise FAST_BAUDS in
+        order.  Returns the rate in use afterwards.
+        """
+        if 'baud' not in self.features:
+            return self.port.baudrate
+        for rate in ([baud] if baud else FAST_BAUDS):
+            if rate == self.port.baudrate:
+                break
+            if self._switch_baud(rate):
+                print(f"Switched to {rate} baud")
+                break
+        return self.port.baudrate
+
+    def _switch_baud(self, rate):
+        """
+        '6' followed by the rate is answered '+' or '-' at the old rate.
+        After a '+' the loader changes rate and waits (about a second) for
+        a 'p' at the new rate, which it answers with 'P'.  If the probe
+        does not get through it goes back to the old rate.
+        """
+        old_rate = self.port.baudrate
+        self.port.reset_input_buffer()
+        self.port.write(self.change_baud_command)
+        self.port.write(f"{rate}\n".encode())
+        self.port.flush()
+        if self.port.read(1) != b'+':
+            return False
+        self.port.baudrate = rate
+        time.sleep(0.05)  # Give the loader time to change over
+        self.port.reset_input_buffer()
+        self.port.write(b'p')
+        if self.port.read(1) == b'P':
+            return True
+        self.port.baudrate = old_rate
+        time.sleep(1.2)  # Wait for the loader to give up and go back
+        self.port.reset_input_buffer()
+        print(f"{rate} baud did not work")
+        return False
+
     def ReadPage(self, address, size):
         assert False, "Not used by TI MCUs"
 
@@ -169,6 +255,35 @@ class FlashLdr:
         ymodem.send(filename)
         print()
 
+    def download_image(self, name, data):
+        """
+        Download a binary image that is already in memory to the MCU.
+        name is only used as the ymodem file name.  Returns True if the
+        transfer worked.  If the loader says it can take YMODEM-G the
+        image is streamed with no ACK per block; if that fails it is sent
+        again the usual way.
+        """
+        if 'ymodem-g' in self.features:
+            start = time.monotonic()
+            if self._download(self.download_streaming_command, name, data):
+                return True
+            print("Streaming failed; sending again with an ACK per block")
+            # What we streamed may still be queued on the way to the loader,
+            # which throws it away until the line goes quiet.  Wait until
+            # all of it would have been on the wire, and then a bit more.
+            wire_time = len(data) * 10 / self.port.baudrate
+            time.sleep(max(0, start + wire_time - time.monotonic()) + 1)
+        return self._download(self.download_application_command, name, data)
+
+    def _download(self, command, name, data):
+        self.port.reset_input_buffer()
+        self.port.write(command)
+        self.port.flush()
+        ymodem = YmodemMCU(self.port)
+        success = ymodem.send_buffer(name, data)
+        self.transfer_counters = ymodem.transport.counters()
+        print()
+        return success
 
 def main():
     loader = FlashLdr(debug=True)
@@ -8,8 +8,119 @@
 # Instruments serial port flash loader.
 #
 
+import io
 import sys
-from modem import YMODEM
+import time
+from modem import YMODEM, const
+
+STREAM = b'G'  # YMODEM-G: the receiver asks for the data with no ACKs
+
+
+class BufferedTransport:
+    """
+    Sits between the ymodem code and the serial port.  The ymodem code
+    reads and writes a few bytes at a time, so this reads ahead whatever
+    has already arrived and saves up small writes until they are big
+    enough to be worth a system call (or until we need an answer).  It
+    also keeps counts, so we can see where the time goes:
+
+      bytes_read, bytes_written  What went over the port
+      reads, writes              How many calls to the port that took
+      stalls, stall_seconds      How often, and how long, we waited
+                                 for the other end
+    """
+
+    def __init__(self, port, chunk_size=4096):
+        self.port = port
+        self.chunk_size = chunk_size
+        self.port_timeout = port.timeout  # Put back by finish()
+        self.read_buffer = bytearray()
+        self.write_buffer = bytearray()
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.reads = 0
+        self.writes = 0
+        self.stalls = 0
+        self.stall_seconds = 0.0
+
+    def read(self, size, timeout=None):
+        """
+        Read size bytes, waiting at most timeout seconds for them (the
+        port's own timeout if None).  Anything we have written goes out
+        first, since it is usually what the other end is answering.
+        Returns fewer than size bytes if the time runs out.
+        """
+        self.flush()
+        if timeout is None:
+            timeout = self.port_timeout
+        if len(self.read_buffer) < size:
+            self._fill(size, timeout)
+        data = bytes(self.read_buffer[:size])
+        del self.read_buffer[:size]
+        self.bytes_read += len(data)
+        return data
+
+    def _fill(self, size, timeout):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        wait = timeout
+        while len(self.read_buffer) < size:
+            want = size - len(self.read_buffer)
+            waiting = self.port.in_waiting
+            if self.port.timeout != wait:
+                self.port.timeout = wait
+            start = time.monotonic()
+            # Take everything that is there (up to a chunk), even if that
+            # is more than we were asked for
+            data = self.port.read(max(want, min(waiting, self.chunk_size)))
+            self.reads += 1
+            if waiting < want:
+                self.stalls += 1
+                self.stall_seconds += time.monotonic() - start
+            self.read_buffer += data
+            if deadline is not None:
+                wait = deadline - time.monotonic()
+                if wait <= 0:
+                    return
+
+    def read_available(self):
+        "Whatever has already arrived, without waiting for more"
+        waiting = self.port.in_waiting
+        if waiting:
+            self.read_buffer += self.port.read(waiting)
+            self.reads += 1
+        data = bytes(self.read_buffer)
+        self.read_buffer.clear()
+        self.bytes_read += len(data)
+        return data
+
+    def write(self, data):
+        self.write_buffer += data
+        if len(self.write_buffer) >= self.chunk_size:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        "Send whatever writes are saved up"
+        if self.write_buffer:
+            self.port.write(self.write_buffer)
+            self.writes += 1
+            self.bytes_written += len(self.write_buffer)
+            self.write_buffer.clear()
+
+    def finish(self):
+        """
+        Flush and give the port back as we found it.  Anything read ahead
+        and not used is dropped; the loader is always sent a new command
+        (with the input cleared) after a transfer anyway.
+        """
+        self.flush()
+        self.port.timeout = self.port_timeout
+
+    def counters(self):
+        return {'bytes_read': self.bytes_read,
+                'bytes_written': self.bytes_written,
+                'reads': self.reads, 'writes': self.writes,
+                'stalls': self.stalls, 'stall_seconds': self.stall_seconds}
 
 
 class YmodemMCU:
@@ -24,21 +135,149 @@ class YmodemMCU:
 
     def __init__(self, serial_port):
         self.port = serial_port
+        self.transport = BufferedTransport(serial_port)
         self.ymodem = YMODEM(self._get_byte, self._put_byte)
 
-    def _get_byte(self, size, timeout=5, debug=False):
+    def _get_byte(self, size, timeout=None, debug=False):
         "Internal callback function used by ymodem to read from serial port"
-        return self.port.read(size)
+        return self.transport.read(size, timeout)
 
-    def _put_byte(self, data, debug=False):
+    def _put_byte(self, data, timeout=None, debug=False):
         "Internal callback function used by ymodem to write to serial port"
-        return self.port.write(data)
+        return self.transport.write(data)
 
     def send(self, file_name):
-        return self.ymodem.send(file_name)
+        try:
+            return self.ymodem.send(file_name)
+        finally:
+            self.transport.finish()
+
+    def send_buffer(self, name, data, retry=3, timeout=10):
+        """
+        Send data (anything bytes-like) as a file called name, without it
+        ever being in a file on this end.  This is the same batch that
+        YMODEM.send makes for one file: the header packet with the name
+        and size, the data, EOT and then the empty header that ends the
+        batch.  If the receiver starts with 'G' rather than 'C' or NAK the
+        data is streamed (YMODEM-G) instead.  timeout is how long to wait
+        for each answer before sending again.  Returns True on success.
+        """
+        try:
+            return self._send_batch(name, data, retry, timeout)
+        finally:
+            self.transport.finish()
+
+    def _send_batch(self, name, data, retry, timeout):
+        ymodem = self.ymodem
+        error_count = 0
+        start_byte = self._wait_start(timeout)
+        if not start_byte:
+            return False
+        streaming = start_byte == STREAM
+        crc_mode = 1 if start_byte in (const.CRC, STREAM) else 0
+
+        header = f"{name}\x00{len(data)}"
+        packet_size = 128 if len(header) < 128 else 1024
+        header = header.ljust(packet_size, '\x00').encode('utf-8')
+        if streaming:
+            # YMODEM-G: nothing is ACKed but the EOT.  The receiver answers
+            # the header with another 'G', and the empty header that ends
+            # the batch is not answered at all.
+            self._write_block(0, header)
+            if self._wait_start(timeout) != STREAM:
+                ymodem.abort(timeout=timeout)
+                return False
+            if not self._stream_data(data, timeout):
+                return False
+            if self._wait_start(timeout) != STREAM:
+                return False
+            self._write_block(0, bytes(128))
+            self.transport.flush()
+            return True
+        if not self._send_header(header, crc_mode, retry, timeout):
+            return False
+        if not ymodem._wait_recv(error_count, timeout):
+            ymodem.abort(timeout=timeout)
+            return False
+        if not ymodem._send_stream(io.BytesIO(data), crc_mode, retry,
+                                   timeout, len(data)):
+            return False
+        if not ymodem._wait_recv(error_count, timeout):
+            return False
+        # End of batch: a header with no file name
+        return self._send_header(bytes(128), crc_mode, retry, timeout)
+
+    def _wait_start(self, timeout):
+        """
+        Wait for the receiver to ask for a packet: NAK (checksums), 'C'
+        (CRC) or 'G' (CRC, streamed).  YMODEM._wait_recv does not know
+        about 'G'.  Returns the byte, or None on a timeout or a cancel.
+        """
+        deadline = time.monotonic() + timeout
+        cancel = False
+        while time.monotonic() < deadline:
+            byte = self.transport.read(1, deadline - time.monotonic())
+            if byte in (const.NAK, const.CRC, STREAM):
+                return byte
+            if byte == const.CAN:
+                if cancel:
+                    return None
+                cancel = True
+            elif byte:
+                cancel = False
+        return None
+
+    def _stream_data(self, data, timeout):
+        """
+        YMODEM-G: send every block back to back without waiting for an
+        ACK, then EOT.  The receiver only says something if a block is bad
+        (it cancels, and the caller can start again the usual way) or
+        when it ACKs the EOT.  Returns True if the EOT was ACKed.
+        """
+        data = memoryview(data)
+        sequence = 1
+        for start in range(0, len(data), 1024):
+            self._write_block(sequence,
+                              bytes(data[start:start + 1024]).ljust(1024, b'\x00'))
+            sequence = (sequence + 1) % 0x100
+            if const.CAN in self.transport.read_available():
+                return False
+            done = min(start + 1024, len(data))
+            print(f"Streamed {done} of {len(data)} bytes", end='\r',
+                  flush=True)
+        self.transport.write(const.EOT)
+        # The receiver may still be working through what is buffered
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            byte = self.transport.read(1, deadline - time.monotonic())
+            if byte == const.ACK:
+                return True
+            if byte == const.CAN:
+                return False
+        return False
+
+    def _write_block(self, sequence, block):
+        "Write one packet with a CRC, without waiting for any answer"
+        start_byte = const.SOH if len(block) == 128 else const.STX
+        crc = self.ymodem.calc_crc16(block)
+        self.transport.write(start_byte + bytes([sequence, 0xff - sequence]) +
+                             block + crc.to_bytes(2, 'big'))
+
+    def _send_header(self, data, crc_mode, retry, timeout):
+        "Send a packet with sequence number 0, as the file headers are"
+        ymodem = self.ymodem
+        crc = ymodem.calc_crc16(data) if crc_mode else ymodem.calc_checksum(data)
+        if not ymodem._send_packet(0, data, len(data), crc_mode, crc, 0,
+                                   retry, timeout):
+            ymodem.abort(timeout=timeout)
+            return False
+        return True
 
     def receive(self, directory):
-        return self.ymodem.recv(directory)
+        try:
+            return self.ymodem.recv(directory)
+        finally:
+            self.transport.finish()
 
 
 def show_error(message):